@@ -0,0 +1,326 @@
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ib1.provenance import Record
+from ib1.provenance.signing import SignerFiles
+from ib1.provenance.certificates import (
+    CertificatesProviderSelfContainedRecord,
+    CertificatesProviderLocal,
+)
+
+# Benchmarks of Record operations on synthetic records of varying shape, using
+# the certificate hierarchy created by scripts/certmaker.sh. Results are written
+# as JSON, and can be compared with the results from another version with
+# --compare to catch regressions.
+#
+#   python3 benchmarks/benchmark.py --output results.json
+#   python3 benchmarks/benchmark.py --compare results.json
+
+TRUST_FRAMEWORK_URL = "https://registry.core.trust.ib1.org/trust-framework"
+SCHEME = "https://registry.core.trust.ib1.org/scheme/perseus"
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bundles and keys created by certmaker.sh, used in turn for each hop
+SIGNERS = [
+    ("123456-bundle.pem", "6-smart-meter-readings-key.pem"),
+    ("98765-bundle.pem", "7-carbon-accounting-provider-key.pem"),
+    ("88889999-bundle.pem", "8-financial-service-provider-key.pem"),
+]
+MEMBERS = [
+    "https://directory.core.trust.ib1.org/member/2876152",
+    "https://directory.core.trust.ib1.org/member/81524",
+    "https://directory.core.trust.ib1.org/member/71212388",
+]
+
+DEFAULT_DEPTHS = [1, 3, 8]
+DEFAULT_BREADTHS = [3, 30]
+DEFAULT_PAYLOAD_SIZES = [0, 1024]
+DEFAULT_PROVIDERS = ["self-contained", "local"]
+
+OPERATIONS = ["sign", "verify", "decoded", "find_step", "to_graphviz"]
+
+
+def make_certificates(directory):
+    # Run certmaker.sh, which expects to be run in a directory next to scripts
+    os.makedirs(directory + "/certs")
+    shutil.copytree(ROOT_DIR + "/scripts", directory + "/scripts")
+    subprocess.run(
+        ["sh", "../scripts/certmaker.sh"],
+        cwd=directory + "/certs",
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return directory + "/certs"
+
+
+def make_provider(provider_type, certs_directory):
+    with open(certs_directory + "/4-signing-ca-cert.pem", "rb") as f:
+        root_ca_certificate = f.read()
+    if provider_type == "self-contained":
+        return CertificatesProviderSelfContainedRecord(root_ca_certificate)
+    elif provider_type == "local":
+        return CertificatesProviderLocal(root_ca_certificate, certs_directory)
+    raise Exception("Unknown provider type: " + provider_type)
+
+
+def make_signers(provider, certs_directory):
+    return [
+        SignerFiles(
+            provider, certs_directory + "/" + bundle, certs_directory + "/" + key
+        )
+        for bundle, key in SIGNERS
+    ]
+
+
+def add_hop_steps(record, hop, breadth, payload_size, previous_transfer_id):
+    # breadth steps for a hop, ending with a transfer to the next member
+    inputs = []
+    if previous_transfer_id is not None:
+        inputs.append(
+            record.add_step({"type": "receipt", "transfer": previous_transfer_id})
+        )
+    payload = "x" * payload_size
+    while len(inputs) < breadth - 2:
+        inputs.append(
+            record.add_step(
+                {"type": "origin", "scheme": SCHEME, "hop": hop, "payload": payload}
+            )
+        )
+    process_id = record.add_step(
+        {"type": "process", "inputs": inputs, "payload": payload}
+    )
+    return record.add_step(
+        {
+            "type": "transfer",
+            "scheme": SCHEME,
+            "of": process_id,
+            "to": MEMBERS[(hop + 1) % len(MEMBERS)],
+            "hop": hop,
+        }
+    )
+
+
+def build_record(provider, signers, depth, breadth, payload_size):
+    # Returns an unsigned Record for the last hop, containing the signed record
+    # of the previous depth - 1 hops
+    encoded = None
+    transfer_id = None
+    for hop in range(depth):
+        if encoded is None:
+            record = Record(TRUST_FRAMEWORK_URL)
+        else:
+            record = Record(TRUST_FRAMEWORK_URL, encoded)
+            record.verify(provider)
+            transfer_id = record.find_step({"type": "transfer", "hop": hop - 1})["id"]
+        transfer_id = add_hop_steps(record, hop, breadth, payload_size, transfer_id)
+        if hop == depth - 1:
+            return record
+        encoded = record.sign(signers[hop % len(signers)]).encoded()
+
+
+def operations(provider, signers, depth, breadth, payload_size):
+    # Functions for each operation, which are timed, and the size of the record.
+    # The provider is shared between runs, so verify measures the steady state
+    # with the provider's certificate and chain caches populated.
+    unsigned = build_record(provider, signers, depth, breadth, payload_size)
+    signer = signers[(depth - 1) % len(signers)]
+    encoded = unsigned.sign(signer).encoded()
+    verified = Record(TRUST_FRAMEWORK_URL, encoded)
+    verified.verify(provider)
+    query = {"type": "transfer", "hop": depth - 1}
+    functions = {
+        "sign": lambda: unsigned.sign(signer),
+        "verify": lambda: Record(TRUST_FRAMEWORK_URL, encoded).verify(provider),
+        "decoded": verified.decoded,
+        "find_step": lambda: verified.find_step(query),
+        "to_graphviz": verified.to_graphviz,
+    }
+    return functions, len(json.dumps(encoded)), len(verified.decoded())
+
+
+def time_operation(function, minimum_time, repeats):
+    # Median time of repeats runs, each of enough calls to take minimum_time
+    function()  # warm up
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minimum_time:
+            break
+        calls *= 2
+    timings = [elapsed / calls]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        timings.append((time.perf_counter() - start) / calls)
+    return statistics.median(timings)
+
+
+def peak_memory(function):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(args, certs_directory):
+    results = []
+    shapes = itertools.product(
+        args.providers, args.depths, args.breadths, args.payload_sizes
+    )
+    for provider_type, depth, breadth, payload_size in shapes:
+        provider = make_provider(provider_type, certs_directory)
+        signers = make_signers(provider, certs_directory)
+        functions, record_size, step_count = operations(
+            provider, signers, depth, breadth, payload_size
+        )
+        for operation in args.operations:
+            seconds = time_operation(
+                functions[operation], args.minimum_time, args.repeats
+            )
+            result = {
+                "provider": provider_type,
+                "depth": depth,
+                "breadth": breadth,
+                "payload_size": payload_size,
+                "operation": operation,
+                "record_size": record_size,
+                "steps": step_count,
+                "seconds": seconds,
+                "operations_per_second": 1 / seconds,
+                "peak_memory": peak_memory(functions[operation]),
+            }
+            results.append(result)
+            print(
+                "{provider:>14} depth={depth:<3} breadth={breadth:<4} "
+                "payload={payload_size:<6} {operation:<12} "
+                "{operations_per_second:>10.1f}/s {peak_memory:>10} bytes".format(
+                    **result
+                ),
+                file=sys.stderr,
+            )
+    return results
+
+
+def result_key(result):
+    return (
+        result["provider"],
+        result["depth"],
+        result["breadth"],
+        result["payload_size"],
+        result["operation"],
+    )
+
+
+def compare(baseline, results, threshold):
+    # Print the change in time for each benchmark, returning the number which
+    # are slower than the baseline by more than threshold
+    baseline_by_key = {result_key(r): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline_by_key.get(result_key(result))
+        if before is None:
+            continue
+        change = result["seconds"] / before["seconds"] - 1
+        regressed = change > threshold
+        regressions += regressed
+        print(
+            "{:>14} depth={:<3} breadth={:<4} payload={:<6} {:<12} {:>+7.1%}{}".format(
+                *result_key(result), change, "  REGRESSION" if regressed else ""
+            )
+        )
+    return regressions
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark provenance records")
+    parser.add_argument(
+        "--certs",
+        help="directory of certificates from scripts/certmaker.sh, created in a "
+        "temporary directory if not given",
+    )
+    parser.add_argument("--depths", type=parse_list, default=DEFAULT_DEPTHS)
+    parser.add_argument("--breadths", type=parse_list, default=DEFAULT_BREADTHS)
+    parser.add_argument(
+        "--payload-sizes", type=parse_list, default=DEFAULT_PAYLOAD_SIZES
+    )
+    parser.add_argument(
+        "--providers",
+        type=lambda v: v.split(","),
+        default=DEFAULT_PROVIDERS,
+    )
+    parser.add_argument(
+        "--operations",
+        type=lambda v: v.split(","),
+        default=OPERATIONS,
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--minimum-time",
+        type=float,
+        default=0.05,
+        help="minimum seconds for each timed run",
+    )
+    parser.add_argument("--output", help="filename for JSON results")
+    parser.add_argument("--compare", help="filename of JSON results to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fractional slowdown reported as a regression by --compare",
+    )
+    args = parser.parse_args()
+    for breadth in args.breadths:
+        if breadth < 3:
+            raise Exception("Breadth must be at least 3 steps")
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        certs_directory = args.certs or make_certificates(temporary_directory)
+        results = run(args, certs_directory)
+
+    output = {
+        "metadata": {
+            "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": subprocess.run(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=ROOT_DIR,
+                capture_output=True,
+                text=True,
+            ).stdout.strip(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
@@ -1,19 +1,83 @@
 import sys
 import os
 import json
+import argparse
+import itertools
 
-from ib1.provenance import Record
+from ib1.provenance import Record, verify_many, validate_record
 from ib1.provenance.certificates import CertificatesProviderSelfContainedRecord
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2 or not os.path.exists(sys.argv[1]):
-        raise Exception("First command line argument must be the filename of a PEM encoded root signing CA certificate.")
-    root_certificate = sys.argv[1]
-    certificate_provider = CertificatesProviderSelfContainedRecord(root_certificate)
+# Number of records read from stdin and verified together in batch mode
+BATCH_SIZE = 1000
+
 
-    record_encoded = json.loads(sys.stdin.read())
+def record_from_line(line):
+    record_encoded = json.loads(line)
+    validate_record(record_encoded)
     # NOTE: When processing provenance records, always specify the Trust Framework expected.
     # This usage is only permissible because it is a general purpose record decoder.
-    record = Record(record_encoded["ib1:provenance"], record_encoded)
-    record.verify(certificate_provider)
-    print(json.dumps(record.decoded(), indent=2).encode("utf-8").decode("utf-8"))
+    return Record(record_encoded["ib1:provenance"], record_encoded)
+
+
+def decode_batch(lines, certificate_provider, workers):
+    # Newline delimited JSON records in, one JSON result per line out
+    line_number = 0
+    while True:
+        batch = list(itertools.islice(lines, BATCH_SIZE))
+        if not batch:
+            break
+        results = [None] * len(batch)
+        records = []
+        for index, line in enumerate(batch):
+            if not line.strip():
+                continue
+            try:
+                records.append((index, record_from_line(line)))
+            except Exception as e:
+                results[index] = {"error": str(e)}
+        verified = verify_many(
+            [record for _, record in records], certificate_provider, workers=workers
+        )
+        for (index, _), (record, error) in zip(records, verified):
+            if error is None:
+                results[index] = {"decoded": record.decoded()}
+            else:
+                results[index] = {"error": str(error)}
+        for result in results:
+            line_number += 1
+            if result is not None:
+                print(json.dumps({"line": line_number, **result}))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify and decode self-contained provenance records"
+    )
+    parser.add_argument(
+        "root_certificate",
+        help="filename of a PEM encoded root signing CA certificate",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="read newline delimited JSON records from stdin, writing one result or error per line",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of threads verifying signatures in batch mode",
+    )
+    args = parser.parse_args()
+    if not os.path.exists(args.root_certificate):
+        raise Exception("First command line argument must be the filename of a PEM encoded root signing CA certificate.")
+    with open(args.root_certificate, "rb") as f:
+        certificate_provider = CertificatesProviderSelfContainedRecord(f.read())
+
+    if args.batch:
+        decode_batch(sys.stdin, certificate_provider, args.workers)
+    else:
+        record = record_from_line(sys.stdin.read())
+        record.verify(certificate_provider)
+        print(json.dumps(record.decoded(), indent=2).encode("utf-8").decode("utf-8"))
@@ -1 +1,7 @@
 from .record import Record  # noqa: F401
+from .batch import verify_many, sign_many  # noqa: F401
+from .query import compile_query  # noqa: F401
+from .stream import verify_stream  # noqa: F401
+from .binary import encode_binary, decode_binary  # noqa: F401
+from .instrumentation import Instrumentation, HistogramInstrumentation  # noqa: F401
+from .validation import validate_record, RecordLimits  # noqa: F401
@@ -0,0 +1,128 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from .record import (
+    Record,
+    _verify_container,
+    _verifies_digests,
+    _certificates_for_record,
+    _sign,
+)
+
+
+def verify_many(
+    records,
+    certificate_provider,
+    workers=None,
+    trust_framework=None,
+    container_cache=None,
+    lazy=False,
+):
+    # Verify many records, sharing the certificate provider's caches and, if
+    # workers is given, a single pool of threads for every signature in the
+    # batch. records may contain Record objects, or encoded records if the
+    # expected trust_framework is given.
+    # Returns a list of (Record, exception) in the same order as records, where
+    # exception is None if the record was verified, so a bad record does not
+    # prevent the rest of the batch from being verified.
+    include_data = not _verifies_digests(certificate_provider)
+    results = []
+    pending = []
+    for r in records:
+        record = r if isinstance(r, Record) else None
+        try:
+            if record is None:
+                if trust_framework is None:
+                    raise Exception(
+                        "trust_framework must be specified to verify encoded records"
+                    )
+                record = Record(trust_framework, r)
+            record._require_signed()
+            containers = record._containers_for_verification(
+                container_cache, include_data
+            )
+            pending.append(
+                (len(results), record, record._certificates_from_record(), containers)
+            )
+            results.append(None)
+        except Exception as e:
+            results.append((record, e))
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Schedule every signature in the batch before waiting for any
+            scheduled = [
+                (
+                    index,
+                    record,
+                    containers,
+                    [
+                        executor.submit(
+                            _verify_container,
+                            certificate_provider,
+                            certificates_from_record,
+                            c,
+                        )
+                        for c in containers
+                    ],
+                )
+                for index, record, certificates_from_record, containers in pending
+            ]
+            for index, record, containers, futures in scheduled:
+                results[index] = _complete_verification(
+                    record,
+                    containers,
+                    (f.result() for f in futures),
+                    container_cache,
+                    lazy,
+                )
+    else:
+        for index, record, certificates_from_record, containers in pending:
+            results[index] = _complete_verification(
+                record,
+                containers,
+                (
+                    _verify_container(
+                        certificate_provider, certificates_from_record, c
+                    )
+                    for c in containers
+                ),
+                container_cache,
+                lazy,
+            )
+    return results
+
+
+def sign_many(records, signer, workers=None):
+    # Sign many records with one signer, returning the signed Records in the
+    # same order. If workers is given, signatures are made on a pool of
+    # threads, which allows requests to remote signers to be made concurrently.
+    records = list(records)
+    signings = [record._prepare_signing(signer) for record in records]
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            signatures = list(
+                executor.map(lambda s: _sign(signer, s[-1]), signings)
+            )
+    else:
+        signatures = [_sign(signer, s[-1]) for s in signings]
+    # Certificates for the record are only serialised once for the whole batch
+    certificates = []
+
+    def certificates_for_record():
+        if not certificates:
+            certificates.append(_certificates_for_record(signer))
+        return certificates[0]
+
+    return [
+        record._complete_signing(signing, signature, certificates_for_record)
+        for record, signing, signature in zip(records, signings, signatures)
+    ]
+
+
+def _complete_verification(record, containers, signer_infos, container_cache, lazy):
+    try:
+        record._complete_verification(
+            containers, list(signer_infos), container_cache, lazy
+        )
+    except Exception as e:
+        return (record, e)
+    return (record, None)
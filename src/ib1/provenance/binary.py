@@ -0,0 +1,258 @@
+import base64
+import json
+import textwrap
+
+# Compact binary form of encoded records, which carries the same signed
+# structure as the JSON form with raw step and signature bytes and DER
+# certificates. Conversion is lossless, so signatures remain valid after a
+# record is converted to binary and back.
+#
+# Layout, where a varint is an unsigned LEB128 integer and bytes/str are a
+# varint length followed by the bytes or UTF-8 text:
+#
+#   magic "IB1P", format version byte, flags byte
+#   trust framework (str)
+#   origins: varint count, then each origin (str)        if FLAG_ORIGINS
+#   certificates: varint count, then for each:          if FLAG_CERTIFICATES
+#       serial (str), varint count, then each certificate (blob)
+#   steps: container
+#   other properties: JSON object (bytes)               if FLAG_OTHER
+#
+#   container: varint count of elements, then each element as
+#       ELEMENT_STEP, step (blob)
+#       ELEMENT_CONTAINER, container
+#       ELEMENT_SIGNATURE, version (varint), serial (str), timestamp (str),
+#           signature (blob)
+#
+#   blob: BLOB_RAW followed by bytes which are base64url or PEM encoded in
+#   the JSON form, or BLOB_TEXT followed by the text (str) if that encoding
+#   would not reproduce the original text exactly.
+
+MAGIC = b"IB1P"
+BINARY_FORMAT_VERSION = 0
+
+FLAG_ORIGINS = 1
+FLAG_CERTIFICATES = 2
+FLAG_OTHER = 4
+
+ELEMENT_STEP = 0
+ELEMENT_CONTAINER = 1
+ELEMENT_SIGNATURE = 2
+
+BLOB_RAW = 0
+BLOB_TEXT = 1
+
+_RECORD_PROPERTIES = ("ib1:provenance", "origins", "certificates", "steps")
+
+
+def encode_binary(encoded):
+    # Binary form of an encoded record, as returned by Record.encoded()
+    if not isinstance(encoded.get("steps"), list):
+        raise Exception("Not an encoded Provenance record")
+    output = bytearray(MAGIC)
+    output.append(BINARY_FORMAT_VERSION)
+    other = {k: v for k, v in encoded.items() if k not in _RECORD_PROPERTIES}
+    flags = 0
+    if "origins" in encoded:
+        flags |= FLAG_ORIGINS
+    if "certificates" in encoded:
+        flags |= FLAG_CERTIFICATES
+    if other:
+        flags |= FLAG_OTHER
+    output.append(flags)
+    _write_str(output, encoded["ib1:provenance"])
+    if "origins" in encoded:
+        _write_varint(output, len(encoded["origins"]))
+        for origin in encoded["origins"]:
+            _write_str(output, origin)
+    if "certificates" in encoded:
+        _write_varint(output, len(encoded["certificates"]))
+        for serial, certificates in encoded["certificates"].items():
+            _write_str(output, serial)
+            _write_varint(output, len(certificates))
+            for certificate in certificates:
+                _write_blob(output, certificate, _pem_to_der, _der_to_pem)
+    _write_container(output, encoded["steps"])
+    if other:
+        _write_bytes(output, json.dumps(other).encode("utf-8"))
+    return bytes(output)
+
+
+def decode_binary(data):
+    # Encoded record, as accepted by Record(), from its binary form
+    reader = _Reader(data)
+    if reader.read(len(MAGIC)) != MAGIC:
+        raise Exception("Not a binary encoded Provenance record")
+    version = reader.read(1)[0]
+    if version != BINARY_FORMAT_VERSION:
+        raise Exception("Cannot decode binary format version: " + str(version))
+    flags = reader.read(1)[0]
+    encoded = {"ib1:provenance": reader.read_str()}
+    if flags & FLAG_ORIGINS:
+        encoded["origins"] = [reader.read_str() for _ in range(reader.read_varint())]
+    if flags & FLAG_CERTIFICATES:
+        certificates = {}
+        for _ in range(reader.read_varint()):
+            serial = reader.read_str()
+            certificates[serial] = [
+                reader.read_blob(_der_to_pem) for _ in range(reader.read_varint())
+            ]
+        encoded["certificates"] = certificates
+    encoded["steps"] = _read_container(reader)
+    if flags & FLAG_OTHER:
+        encoded.update(json.loads(reader.read_bytes()))
+    if not reader.at_end():
+        raise Exception("Unexpected data after binary encoded Provenance record")
+    return encoded
+
+
+def _write_container(output, container):
+    _write_varint(output, len(container))
+    for e in container:
+        if isinstance(e, str):
+            output.append(ELEMENT_STEP)
+            _write_blob(output, e, _base64_to_bytes, _bytes_to_base64)
+        elif _is_signature_block(e):
+            version, serial, sign_timestamp, signature = e
+            output.append(ELEMENT_SIGNATURE)
+            _write_varint(output, version)
+            _write_str(output, serial)
+            _write_str(output, sign_timestamp)
+            _write_blob(output, signature, _base64_to_bytes, _bytes_to_base64)
+        elif isinstance(e, list):
+            output.append(ELEMENT_CONTAINER)
+            _write_container(output, e)
+        else:
+            raise Exception("Cannot encode container element in binary format")
+
+
+def _read_container(reader):
+    container = []
+    for _ in range(reader.read_varint()):
+        element_type = reader.read(1)[0]
+        if element_type == ELEMENT_STEP:
+            container.append(reader.read_blob(_bytes_to_base64))
+        elif element_type == ELEMENT_SIGNATURE:
+            container.append(
+                [
+                    reader.read_varint(),
+                    reader.read_str(),
+                    reader.read_str(),
+                    reader.read_blob(_bytes_to_base64),
+                ]
+            )
+        elif element_type == ELEMENT_CONTAINER:
+            container.append(_read_container(reader))
+        else:
+            raise Exception("Bad element in binary encoded Provenance record")
+    return container
+
+
+def _is_signature_block(e):
+    return (
+        isinstance(e, list)
+        and len(e) == 4
+        and isinstance(e[0], int)
+        and not isinstance(e[0], bool)
+        and e[0] >= 0
+        and all(isinstance(x, str) for x in e[1:])
+    )
+
+
+def _write_varint(output, value):
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def _write_bytes(output, value):
+    _write_varint(output, len(value))
+    output.extend(value)
+
+
+def _write_str(output, value):
+    _write_bytes(output, value.encode("utf-8"))
+
+
+def _write_blob(output, text, to_bytes, from_bytes):
+    # Raw bytes if they convert back to exactly the same text
+    try:
+        raw = to_bytes(text)
+    except ValueError:
+        raw = None
+    if raw is not None and from_bytes(raw) == text:
+        output.append(BLOB_RAW)
+        _write_bytes(output, raw)
+    else:
+        output.append(BLOB_TEXT)
+        _write_str(output, text)
+
+
+def _base64_to_bytes(text):
+    return base64.urlsafe_b64decode(text)
+
+
+def _bytes_to_base64(raw):
+    return base64.urlsafe_b64encode(raw).decode("utf-8")
+
+
+def _pem_to_der(text):
+    lines = text.strip().split("\n")
+    if (
+        len(lines) < 2
+        or lines[0] != "-----BEGIN CERTIFICATE-----"
+        or lines[-1] != "-----END CERTIFICATE-----"
+    ):
+        raise ValueError("Not a PEM encoded certificate")
+    return base64.b64decode("".join(lines[1:-1]))
+
+
+def _der_to_pem(raw):
+    # Same layout as cryptography's PEM encoding
+    return (
+        "-----BEGIN CERTIFICATE-----\n"
+        + "\n".join(textwrap.wrap(base64.b64encode(raw).decode("ascii"), 64))
+        + "\n-----END CERTIFICATE-----\n"
+    )
+
+
+class _Reader:
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._position = 0
+
+    def read(self, length):
+        end = self._position + length
+        if end > len(self._data):
+            raise Exception("Unexpected end of binary encoded Provenance record")
+        value = self._data[self._position : end]
+        self._position = end
+        return value
+
+    def read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read(1)[0]
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_bytes(self):
+        return self.read(self.read_varint()).tobytes()
+
+    def read_str(self):
+        return str(self.read(self.read_varint()), "utf-8")
+
+    def read_blob(self, from_bytes):
+        blob_type = self.read(1)[0]
+        if blob_type == BLOB_RAW:
+            return from_bytes(self.read_bytes())
+        elif blob_type == BLOB_TEXT:
+            return self.read_str()
+        raise Exception("Bad value in binary encoded Provenance record")
+
+    def at_end(self):
+        return self._position == len(self._data)
@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Bounded, thread safe mapping which evicts the least recently used entry
+    # when full. A maximum_size of 0 disables caching entirely.
+
+    def __init__(self, maximum_size=1024):
+        if maximum_size < 0:
+            raise ValueError("maximum_size must not be negative")
+        self.maximum_size = maximum_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maximum_size == 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maximum_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def statistics(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maximum_size": self.maximum_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class VerifiedContainerCache(LRUCache):
+    # Signer information for containers whose signatures, and the signatures
+    # of all the containers nested within them, have been verified. Keyed by
+    # the SHA-256 digest of the signed data and the signature.
+
+    @staticmethod
+    def key(digest, signature):
+        return digest + signature
@@ -1,17 +1,36 @@
+import base64
 import datetime
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import Future
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID, ExtensionOID
 from cryptography.x509.verification import PolicyBuilder, Store
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
 import asn1crypto.core as asn1
 
+from .cache import LRUCache
+from .httpclient import HTTPConnectionPool
+from .instrumentation import NULL_INSTRUMENTATION
+
 # ---------------------------------------------------------------------------
 
 OID_IB1_ROLES = x509.ObjectIdentifier("1.3.6.1.4.1.62329.1.1")
 OID_IB1_MEMBER = x509.ObjectIdentifier("1.3.6.1.4.1.62329.1.3")
 
+BUNDLE_FILENAME_SUFFIX = "-bundle.pem"
+
+# Certificates in the certificates property of a record may be replaced by a
+# reference, which is this prefix followed by the hex SHA-256 digest of the DER
+# encoded certificate, ie its fingerprint.
+CERTIFICATE_REFERENCE_PREFIX = "sha256:"
+
 
 class CertExtUTF8Sequence(asn1.SequenceOf):
     _child_spec = asn1.UTF8String
@@ -46,51 +65,524 @@ class SigningCertificate:
         return list(map(str, CertExtUTF8Sequence.load(value)))
 
 
+def certificates_for_record(certificates: list[x509.Certificate]) -> dict:
+    # Represent the signing certificate's path as
+    #   {serial: [pem encoded cert, serials of issuer chain ...],
+    #    issuer serial: [pem encoded cert], ...}
+    # for the certificates property of a record
+    first_cert, *other_certs = certificates
+    cert_path = [first_cert.public_bytes(serialization.Encoding.PEM).decode("utf-8")]
+    cert_path.extend(list(map(lambda c: str(c.serial_number), other_certs)))
+    result = {str(first_cert.serial_number): cert_path}
+    for c in other_certs:
+        result[str(c.serial_number)] = [
+            c.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+        ]
+    return result
+
+
+def certificate_reference(certificate: x509.Certificate) -> str:
+    return CERTIFICATE_REFERENCE_PREFIX + certificate.fingerprint(hashes.SHA256()).hex()
+
+
+def is_certificate_reference(value: str) -> bool:
+    return value.startswith(CERTIFICATE_REFERENCE_PREFIX)
+
+
+def _pem_reference(pem: str) -> str:
+    # As certificate_reference(), without parsing the certificate
+    body = pem.split("-----")[2]
+    return (
+        CERTIFICATE_REFERENCE_PREFIX
+        + hashlib.sha256(base64.b64decode(body)).hexdigest()
+    )
+
+
+def reference_certificates(certificates_from_record: dict, references) -> dict:
+    # Copy of the certificates property of a record, with the certificates
+    # whose references are in references (eg a set, or a CertificateBundle of
+    # the certificates the receiver already has) replaced by their references.
+    # Certificates are not signed, so this doesn't affect signatures.
+    result = {}
+    for serial, certs in certificates_from_record.items():
+        certificate, *path_serials = certs
+        if not is_certificate_reference(certificate):
+            reference = _pem_reference(certificate)
+            if reference in references:
+                certificate = reference
+        result[serial] = [certificate, *path_serials]
+    return result
+
+
+def merge_certificates(certificates: dict, certificates_from_record: dict):
+    # Merge the certificates property of a record into certificates, preferring
+    # included certificates to references. Lists are copied, so certificates
+    # doesn't share them with certificates_from_record.
+    for serial, certs in certificates_from_record.items():
+        existing = certificates.get(serial)
+        if existing is None or (
+            is_certificate_reference(existing[0])
+            and not is_certificate_reference(certs[0])
+        ):
+            certificates[serial] = list(certs)
+
+
+class CertificateBundle:
+    # Certificates keyed by reference, used by CertificatesProviderSelfContainedRecord
+    # to fill in certificates which records reference rather than include.
+
+    def __init__(self, pem: bytes | None = None):
+        self._certificates: dict[str, x509.Certificate] = {}
+        if pem is not None:
+            self.add_pem(pem)
+
+    def add_pem(self, pem: bytes) -> list[str]:
+        # Add PEM encoded certificates, returning their references
+        return list(map(self.add_certificate, x509.load_pem_x509_certificates(pem)))
+
+    def add_certificate(self, certificate: x509.Certificate) -> str:
+        reference = certificate_reference(certificate)
+        self._certificates[reference] = certificate
+        return reference
+
+    def add_certificates_from_record(self, certificates_from_record: dict) -> list[str]:
+        # Add the certificates included in the certificates property of a record,
+        # eg so they can be referenced in records sent back to the sender
+        return [
+            self.add_certificate(x509.load_pem_x509_certificate(c[0].encode("utf-8")))
+            for c in certificates_from_record.values()
+            if not is_certificate_reference(c[0])
+        ]
+
+    def certificate(self, reference: str) -> x509.Certificate:
+        certificate = self._certificates.get(reference)
+        if certificate is None:
+            raise KeyError("Certificate " + reference + " is not in bundle")
+        return certificate
+
+    def references(self) -> frozenset[str]:
+        return frozenset(self._certificates)
+
+    def __contains__(self, reference):
+        return reference in self._certificates
+
+    def __len__(self):
+        return len(self._certificates)
+
+
+class SignerInfo(dict):
+    # Immutable information about the signer of a container, returned by
+    # verify() as a dict with member, name, application and roles (a tuple)
+    # keys. Instances are interned, so every container signed by the same
+    # signer, in any record, shares one object. Verified steps include plain
+    # dicts of the information.
+
+    __slots__ = ("__weakref__",)
+
+    _interned = weakref.WeakValueDictionary()  # type: ignore [var-annotated]
+    _interned_lock = threading.Lock()
+
+    @classmethod
+    def intern(cls, member, name, application, roles):
+        roles = tuple(roles)
+        key = (member, name, application, roles)
+        with cls._interned_lock:
+            signer_info = cls._interned.get(key)
+            if signer_info is None:
+                signer_info = cls(
+                    member=member, name=name, application=application, roles=roles
+                )
+                cls._interned[key] = signer_info
+        return signer_info
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("SignerInfo is immutable")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash((self["member"], self["name"], self["application"], self["roles"]))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (
+            SignerInfo.intern,
+            (self["member"], self["name"], self["application"], self["roles"]),
+        )
+
+    def __repr__(self):
+        return "SignerInfo(" + dict.__repr__(self) + ")"
+
+
 class CertificateProviderBase:
-    def __init__(self, root_ca_certificate: bytes, self_contained=False):
+    def __init__(
+        self,
+        root_ca_certificate: bytes,
+        self_contained=False,
+        chain_verification_cache_size=256,
+        instrumentation=None,
+    ):
         self.policy_include_certificates_in_record = self_contained
+        # Also used by Record when verifying with this provider
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        self._ca_store = Store(x509.load_pem_x509_certificates(root_ca_certificate))
+        # Chains which have been proven valid, keyed by (serial, chain fingerprint),
+        # with the validity window over which that proof holds.
+        self.chain_verification_cache = LRUCache(chain_verification_cache_size)
+
+    def set_root_ca_certificate(self, root_ca_certificate: bytes):
         self._ca_store = Store(x509.load_pem_x509_certificates(root_ca_certificate))
+        self.invalidate_chain_verification_cache()
+
+    def invalidate_chain_verification_cache(self):
+        # Must be called if anything affecting chain validity changes, eg trust store
+        self.chain_verification_cache.clear()
+
+    def prefetch(self, serials):
+        # Load the certificates for serials before verification, raising an
+        # exception for unknown signers. Returns the serials loaded, if any.
+        return []
+
+    def prefetch_record(self, record):
+        # prefetch() the certificates of every signer of a Record
+        return self.prefetch(serial for serial, _ in record.signatures())
 
     def verify(self, certificates_from_record, serial, sign_timestamp, data, signature):
-        certs = self.certificates_for_serial(certificates_from_record, serial)
+        return self._verify(
+            certificates_from_record,
+            serial,
+            sign_timestamp,
+            data,
+            signature,
+            ec.ECDSA(hashes.SHA256()),
+        )
+
+    def verify_digest(
+        self, certificates_from_record, serial, sign_timestamp, digest, signature
+    ):
+        # As verify(), but given the SHA-256 digest of the data
+        return self._verify(
+            certificates_from_record,
+            serial,
+            sign_timestamp,
+            digest,
+            signature,
+            ec.ECDSA(utils.Prehashed(hashes.SHA256())),
+        )
+
+    def _verify(
+        self,
+        certificates_from_record,
+        serial,
+        sign_timestamp,
+        data,
+        signature,
+        signature_algorithm,
+    ):
+        instrumentation = self.instrumentation
+        with instrumentation.phase("certificates.load"):
+            certs = self.certificates_for_serial(certificates_from_record, serial)
         # first certificate in file is signing certificate
         signing_cert, *issuer_chain = certs
         # 1) check certificate chain validity at the time of signature
         verification_time = datetime.datetime.fromisoformat(sign_timestamp)
+        with instrumentation.phase("certificates.chain"):
+            signer_info = self._verify_chain(
+                serial, signing_cert, issuer_chain, verification_time
+            )
+        # 2) check signature on data
+        with instrumentation.phase("certificates.signature"):
+            pubkey = signing_cert.public_key()
+            pubkey.verify(signature, data, signature_algorithm)
+        # Return information about the signer, which is immutable so is shared
+        return signer_info
+
+    def _verify_chain(self, serial, signing_cert, issuer_chain, verification_time):
+        # Validity of a chain only depends on time through the validity periods of
+        # the certificates in it, so once a chain has been verified it's valid at
+        # any time within the intersection of those periods.
+        cache_key = (
+            serial,
+            tuple(
+                c.fingerprint(hashes.SHA256()) for c in [signing_cert, *issuer_chain]
+            ),
+        )
+        comparison_time = verification_time
+        if comparison_time.tzinfo is None:
+            comparison_time = comparison_time.replace(tzinfo=datetime.timezone.utc)
+        cached = self.chain_verification_cache.get(cache_key)
+        if cached is not None:
+            valid_from, valid_until, signer_info = cached
+            if valid_from <= comparison_time <= valid_until:
+                self.instrumentation.cache("certificates.chain", True)
+                return signer_info
+        self.instrumentation.cache("certificates.chain", False)
         verifier = (
             PolicyBuilder()
             .store(self._ca_store)
             .time(verification_time)
             .build_client_verifier()
         )
-        verifier.verify(signing_cert, issuer_chain)
-        # 2) check signature on data
-        pubkey = signing_cert.public_key()
-        pubkey.verify(signature, data, ec.ECDSA(hashes.SHA256()))
-        # Return information about the signer
+        verified_client = verifier.verify(signing_cert, issuer_chain)
+        valid_from = max(c.not_valid_before_utc for c in verified_client.chain)
+        valid_until = min(c.not_valid_after_utc for c in verified_client.chain)
         cert_info = SigningCertificate(signing_cert)
-        return {
-            "member": cert_info.member(),
-            "name": cert_info.organisation_name(),
-            "application": cert_info.application(),
-            "roles": cert_info.roles(),
-        }
+        signer_info = SignerInfo.intern(
+            cert_info.member(),
+            cert_info.organisation_name(),
+            cert_info.application(),
+            cert_info.roles(),
+        )
+        self.chain_verification_cache.put(
+            cache_key, (valid_from, valid_until, signer_info)
+        )
+        return signer_info
 
 
 class CertificatesProviderLocal(CertificateProviderBase):
-    def __init__(self, root_ca_certificate, directory):
-        CertificateProviderBase.__init__(self, root_ca_certificate)
+    def __init__(
+        self,
+        root_ca_certificate,
+        directory,
+        certificate_cache_size=256,
+        preload=False,
+        **kwargs,
+    ):
+        CertificateProviderBase.__init__(self, root_ca_certificate, **kwargs)
         self._directory = directory
+        # Parsed certificates keyed by serial, with the mtime and size of the
+        # bundle file they were loaded from so changes on disk are noticed.
+        self.certificate_cache = LRUCache(certificate_cache_size)
+        if preload:
+            self.preload()
 
     def certificates_for_serial(self, certificates_from_record, serial):
-        certificate_filename = self._directory + "/" + str(int(serial)) + "-bundle.pem"
+        serial = str(int(serial))
+        certificate_filename = self._bundle_filename(serial)
+        stat = os.stat(certificate_filename)
+        cached = self.certificate_cache.get(serial)
+        if cached is not None:
+            mtime_ns, size, certs = cached
+            if mtime_ns == stat.st_mtime_ns and size == stat.st_size:
+                self.instrumentation.cache("certificates.certificate", True)
+                return certs.copy()
+        self.instrumentation.cache("certificates.certificate", False)
+        return self._load_bundle(serial, certificate_filename).copy()
+
+    def prefetch(self, serials):
+        loaded = []
+        for serial in sorted(set(str(int(s)) for s in serials)):
+            if serial not in self.certificate_cache:
+                self._load_bundle(serial, self._bundle_filename(serial))
+                loaded.append(serial)
+        return loaded
+
+    def preload(self):
+        # Load every bundle in the directory, eg at startup, so that verification
+        # doesn't need to read files. Returns the serials loaded.
+        serials = []
+        for filename in sorted(os.listdir(self._directory)):
+            serial = filename.removesuffix(BUNDLE_FILENAME_SUFFIX)
+            if serial != filename and serial.isdigit() and str(int(serial)) == serial:
+                self._load_bundle(serial, self._bundle_filename(serial))
+                serials.append(serial)
+        return serials
+
+    def _bundle_filename(self, serial):
+        return self._directory + "/" + serial + BUNDLE_FILENAME_SUFFIX
+
+    def _load_bundle(self, serial, certificate_filename):
         with open(certificate_filename, "rb") as f:
-            return x509.load_pem_x509_certificates(f.read())
+            stat = os.fstat(f.fileno())
+            certs = x509.load_pem_x509_certificates(f.read())
+        self.certificate_cache.put(serial, (stat.st_mtime_ns, stat.st_size, certs))
+        return certs
+
+
+class CertificatesProviderDirectory(CertificateProviderBase):
+    # Fetches certificate bundles by serial from the Directory over HTTP, from
+    # base_url + "/" + serial + BUNDLE_FILENAME_SUFFIX, using a pool of
+    # keep-alive connections.
+    #
+    # Bundles are cached in memory and, if cache_directory is given, on disk
+    # so they survive restarts. A bundle is fresh for ttl seconds after it was
+    # fetched, then for stale_while_revalidate seconds it's still used while it
+    # is fetched again in the background. Concurrent requests for the same
+    # serial are coalesced into a single fetch. Serials which aren't in the
+    # Directory are remembered for not_found_ttl seconds, so records with
+    # unknown signers are rejected without making more requests.
+
+    def __init__(
+        self,
+        root_ca_certificate,
+        base_url,
+        cache_directory=None,
+        ttl=3600,
+        stale_while_revalidate=86400,
+        not_found_ttl=60,
+        max_connections=8,
+        timeout=10,
+        certificate_cache_size=256,
+        clock=time.time,
+        **kwargs,
+    ):
+        CertificateProviderBase.__init__(self, root_ca_certificate, **kwargs)
+        self._pool = HTTPConnectionPool(base_url, max_connections, timeout)
+        self._cache_directory = cache_directory
+        self._ttl = ttl
+        self._stale_while_revalidate = stale_while_revalidate
+        self._not_found_ttl = not_found_ttl
+        self._clock = clock
+        # Parsed certificates keyed by serial, with the time they were fetched
+        self.certificate_cache = LRUCache(certificate_cache_size)
+        # Time the Directory responded that a serial wasn't found, keyed by serial
+        self.not_found_cache = LRUCache(certificate_cache_size)
+        # Futures for fetches in progress, keyed by serial
+        self._fetches = {}
+        self._fetches_lock = threading.Lock()
+
+    def certificates_for_serial(self, certificates_from_record, serial):
+        serial = str(int(serial))
+        cached = self._cached(serial)
+        if cached is not None:
+            fetched_at, certs = cached
+            age = self._clock() - fetched_at
+            if age < self._ttl:
+                self.instrumentation.cache("certificates.certificate", True)
+                return certs.copy()
+            if age < self._ttl + self._stale_while_revalidate:
+                self.instrumentation.cache("certificates.certificate", True)
+                self._fetch(serial, background=True)
+                return certs.copy()
+        self._check_not_found(serial)
+        self.instrumentation.cache("certificates.certificate", False)
+        return self._fetch(serial).result().copy()
+
+    def prefetch(self, serials):
+        # Fetch the bundles for serials which aren't fresh in the cache, making
+        # the requests concurrently. Returns the serials fetched. Raises KeyError
+        # without making any requests if a serial is known not to be in the
+        # Directory.
+        now = self._clock()
+        missing = []
+        for serial in sorted(set(str(int(s)) for s in serials)):
+            cached = self._cached(serial)
+            if cached is None:
+                self._check_not_found(serial)
+            if cached is None or now - cached[0] >= self._ttl:
+                missing.append(serial)
+        futures = [self._fetch(serial, background=True) for serial in missing]
+        for future in futures:
+            future.result()
+        return missing
+
+    def close(self):
+        self._pool.close()
+
+    def _check_not_found(self, serial):
+        not_found_at = self.not_found_cache.get(serial)
+        if not_found_at is not None:
+            if self._clock() - not_found_at < self._not_found_ttl:
+                raise KeyError("Certificate serial " + serial + " is not in Directory")
+            self.not_found_cache.discard(serial)
+
+    def _cached(self, serial):
+        # (fetched_at, certs) from memory, or from disk, or None
+        cached = self.certificate_cache.get(serial)
+        if cached is None and self._cache_directory is not None:
+            filename = self._cache_filename(serial)
+            try:
+                with open(filename, "rb") as f:
+                    fetched_at = os.fstat(f.fileno()).st_mtime
+                    cached = (fetched_at, x509.load_pem_x509_certificates(f.read()))
+            except FileNotFoundError:
+                return None
+            self.certificate_cache.put(serial, cached)
+        return cached
+
+    def _fetch(self, serial, background=False):
+        # Returns a Future for the certificates, fetching them unless a fetch is
+        # already in progress. Background fetches are made on a new thread.
+        with self._fetches_lock:
+            future = self._fetches.get(serial)
+            if future is not None:
+                return future
+            future = Future()
+            self._fetches[serial] = future
+        if background:
+            threading.Thread(
+                target=self._fetch_into, args=(serial, future), daemon=True
+            ).start()
+        else:
+            self._fetch_into(serial, future)
+        return future
+
+    def _fetch_into(self, serial, future):
+        try:
+            with self.instrumentation.phase("certificates.fetch"):
+                status, body = self._pool.get("/" + serial + BUNDLE_FILENAME_SUFFIX)
+            if status == 404:
+                self.not_found_cache.put(serial, self._clock())
+                raise KeyError("Certificate serial " + serial + " is not in Directory")
+            if status != 200:
+                raise Exception(
+                    "Directory returned HTTP status "
+                    + str(status)
+                    + " for certificate serial "
+                    + serial
+                )
+            certs = x509.load_pem_x509_certificates(body)
+            if str(certs[0].serial_number) != serial:
+                raise Exception(
+                    "Directory returned wrong certificate for serial " + serial
+                )
+            fetched_at = self._clock()
+            if self._cache_directory is not None:
+                self._write_cache_file(serial, body, fetched_at)
+            self.certificate_cache.put(serial, (fetched_at, certs))
+            future.set_result(certs)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._fetches_lock:
+                del self._fetches[serial]
+
+    def _cache_filename(self, serial):
+        return self._cache_directory + "/" + serial + BUNDLE_FILENAME_SUFFIX
+
+    def _write_cache_file(self, serial, body, fetched_at):
+        # Write atomically, with the modification time as the time fetched
+        fd, temporary_filename = tempfile.mkstemp(dir=self._cache_directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.utime(temporary_filename, (fetched_at, fetched_at))
+            os.replace(temporary_filename, self._cache_filename(serial))
+        except BaseException:
+            os.unlink(temporary_filename)
+            raise
 
 
 class CertificatesProviderSelfContainedRecord(CertificateProviderBase):
-    def __init__(self, root_ca_certificate: bytes):
-        super().__init__(root_ca_certificate, self_contained=True)
+    def __init__(
+        self,
+        root_ca_certificate: bytes,
+        certificate_cache_size=256,
+        certificate_bundle: CertificateBundle | None = None,
+        **kwargs,
+    ):
+        super().__init__(root_ca_certificate, self_contained=True, **kwargs)
+        # Parsed certificates keyed by their PEM text, so an issuer shared by
+        # many containers and records is only parsed once.
+        self.certificate_cache = LRUCache(certificate_cache_size)
+        # Certificates referenced by records, rather than included in them
+        self.certificate_bundle = certificate_bundle
 
     def certificates_for_serial(
         self, certificates_from_record: dict, serial: str
@@ -103,6 +595,18 @@ class CertificatesProviderSelfContainedRecord(CertificateProviderBase):
         cert_chain.extend(
             list(map(lambda s: certificates_from_record[s][0], path_serials))
         )
-        return list(
-            map(lambda c: x509.load_pem_x509_certificate(c.encode("utf-8")), cert_chain)
-        )
+        return list(map(self._load_pem_certificate, cert_chain))
+
+    def _load_pem_certificate(self, pem: str) -> x509.Certificate:
+        if is_certificate_reference(pem):
+            if self.certificate_bundle is None:
+                raise KeyError(
+                    "Certificate " + pem + " is referenced, but there is no bundle"
+                )
+            return self.certificate_bundle.certificate(pem)
+        certificate = self.certificate_cache.get(pem)
+        self.instrumentation.cache("certificates.certificate", certificate is not None)
+        if certificate is None:
+            certificate = x509.load_pem_x509_certificate(pem.encode("utf-8"))
+            self.certificate_cache.put(pem, certificate)
+        return certificate
@@ -0,0 +1,76 @@
+import http.client
+import queue
+import threading
+import urllib.parse
+
+
+class HTTPConnectionPool:
+    # Thread safe pool of keep-alive connections to a single HTTP or HTTPS
+    # server. At most max_connections requests are made concurrently.
+
+    def __init__(self, base_url, max_connections=8, timeout=10):
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme == "https":
+            self._connection_class = http.client.HTTPSConnection
+        elif url.scheme == "http":
+            self._connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError("Unsupported URL scheme: " + base_url)
+        self._host = url.netloc
+        self._path_prefix = url.path.rstrip("/")
+        self._timeout = timeout
+        self._available = threading.BoundedSemaphore(max_connections)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    def get(self, path):
+        # Returns (status, body) of a GET request for the path below base_url
+        with self._available:
+            connection, reused = self._connection()
+            try:
+                response = self._request(connection, path)
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server may have closed an idle keep-alive connection
+                connection, reused = self._new_connection(), False
+                try:
+                    response = self._request(connection, path)
+                except BaseException:
+                    connection.close()
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+            status, body, will_close = response
+            if will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+            return status, body
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _connection(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _new_connection(self):
+        with self._lock:
+            self.connections_opened += 1
+        return self._connection_class(self._host, timeout=self._timeout)
+
+    def _request(self, connection, path):
+        connection.request("GET", self._path_prefix + path)
+        response = connection.getresponse()
+        body = response.read()
+        return response.status, body, response.will_close
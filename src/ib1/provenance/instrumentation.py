@@ -0,0 +1,169 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# Instrumentation of the phases of signing and verifying records. Certificate
+# providers and signers take an instrumentation argument, and Record uses the
+# instrumentation of the provider or signer it's given. Phases are named with
+# the class of object and the phase, eg "record.verify.decode", and are:
+#
+#   record.verify                 whole of Record.verify()
+#   record.verify.containers      gathering containers and hashing signed data
+#   record.verify.signatures      verifying signatures of all containers
+#   record.verify.decode          decoding steps and checking origins
+#   record.sign                   whole of Record.sign()
+#   record.sign.prepare           encoding steps and hashing data to sign
+#   certificates.load             finding and parsing certificates for a serial
+#   certificates.fetch            fetching a bundle from the Directory
+#   certificates.chain            verifying certificate chains
+#   certificates.signature        verifying an ECDSA signature
+#   signer.sign                   signing, including any call to AWS KMS
+#
+# Counts are record.verify.containers, record.verify.steps, record.verify.bytes
+# (length of encoded steps), record.sign.steps and record.sign.bytes (length of
+# the canonical data signed, whether or not the signer signs digests). Caches are
+# record.container_cache, certificates.chain and certificates.certificate.
+
+
+class Instrumentation:
+    # Base class for instrumentation, which does nothing.
+
+    def phase(self, name):
+        # Context manager to time a phase
+        return _NULL_CONTEXT
+
+    def duration(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def cache(self, name, hit):
+        pass
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+class _PhaseTimer:
+    __slots__ = ("_instrumentation", "_name", "_start")
+
+    def __init__(self, instrumentation, name):
+        self._instrumentation = instrumentation
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._instrumentation.duration(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class TimingInstrumentation(Instrumentation):
+    # Base class for instrumentation which times phases, calling duration()
+
+    def phase(self, name):
+        return _PhaseTimer(self, name)
+
+
+# Upper bounds of histogram buckets for durations, in seconds, from 1µs to
+# about 100s with four buckets per doubling, so percentiles are within 19%.
+HISTOGRAM_BUCKETS = tuple(1e-6 * 2 ** (i / 4) for i in range(108))
+
+
+class HistogramInstrumentation(TimingInstrumentation):
+    # Aggregates durations into histograms, and totals counts and cache
+    # lookups, in a thread safe way. export() returns a dict suitable for
+    # encoding as JSON, eg for a metrics endpoint.
+
+    def __init__(self, percentiles=(50, 90, 99)):
+        self._percentiles = percentiles
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counts = {}
+            self._caches = {}
+
+    def duration(self, name, seconds):
+        bucket = bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = _Histogram()
+                self._histograms[name] = histogram
+            histogram.add(bucket, seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def cache(self, name, hit):
+        with self._lock:
+            hits, misses = self._caches.get(name, (0, 0))
+            self._caches[name] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def export(self):
+        with self._lock:
+            return {
+                "durations": {
+                    name: histogram.export(self._percentiles)
+                    for name, histogram in self._histograms.items()
+                },
+                "counts": dict(self._counts),
+                "caches": {
+                    name: {"hits": hits, "misses": misses}
+                    for name, (hits, misses) in self._caches.items()
+                },
+            }
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "total", "minimum", "maximum")
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, bucket, seconds):
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+    def export(self, percentiles):
+        result = {
+            "count": self.count,
+            "total": self.total,
+            "min": self.minimum,
+            "max": self.maximum,
+        }
+        for percentile in percentiles:
+            result["p" + str(percentile)] = self._percentile(percentile)
+        return result
+
+    def _percentile(self, percentile):
+        # Upper bound of the bucket containing the percentile, limited to the
+        # range of durations actually seen
+        rank = percentile / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if bucket == len(HISTOGRAM_BUCKETS):
+                    return self.maximum
+                return min(max(HISTOGRAM_BUCKETS[bucket], self.minimum), self.maximum)
+        return self.maximum
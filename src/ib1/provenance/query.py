@@ -0,0 +1,104 @@
+import copy
+from collections.abc import Mapping
+
+# Keys for indexes of signer information, which can't clash with step keys
+SIGNER_MEMBER_INDEX = ("_signature", "signed", "member")
+SIGNER_ROLES_INDEX = ("_signature", "signed", "roles")
+
+
+def compile_query(required_values):
+    # Compile the required values for Record.find_step() and filter_steps()
+    # into a reusable, immutable query which can be shared between threads.
+    return CompiledQuery(required_values)
+
+
+class CompiledQuery:
+    # A step matches if:
+    #   * for a dict, the step is a dict and contains all the keys, with the
+    #     values matching the values in the dict
+    #   * for a list, the step is a list and every element matches at least one
+    #     element of the step
+    #   * otherwise, the step is equal to the value
+
+    __slots__ = ("required_values", "index_lookups", "_matcher")
+
+    def __init__(self, required_values):
+        self.required_values = copy.deepcopy(required_values)
+        self.index_lookups = tuple(_index_lookups(self.required_values))
+        self._matcher = _compile(self.required_values)
+
+    def matches(self, step):
+        return self._matcher(step)
+
+    def __repr__(self):
+        return "CompiledQuery(" + repr(self.required_values) + ")"
+
+
+def _compile(required_values):
+    if isinstance(required_values, dict):
+        # Primitive values are compared directly, rather than through a matcher
+        equal = tuple(
+            (k, v) for k, v in required_values.items() if not _is_structure(v)
+        )
+        nested = tuple(
+            (k, _compile(v)) for k, v in required_values.items() if _is_structure(v)
+        )
+
+        def match_dict(step):
+            if not isinstance(step, Mapping):
+                return False
+            for key, value in equal:
+                if key not in step or step[key] != value:
+                    return False
+            for key, matcher in nested:
+                if key not in step or not matcher(step[key]):
+                    return False
+            return True
+
+        return match_dict
+    elif isinstance(required_values, list):
+        equal = tuple(v for v in required_values if not _is_structure(v))
+        nested = tuple(_compile(v) for v in required_values if _is_structure(v))
+
+        def match_list(step):
+            if not isinstance(step, list):
+                return False
+            for value in equal:
+                if value not in step:
+                    return False
+            for matcher in nested:
+                if not any(matcher(x) for x in step):
+                    return False
+            return True
+
+        return match_list
+    else:
+        return lambda step: step == required_values
+
+
+def _index_lookups(required_values):
+    # (index key, value) pairs which a step must be in the index under to match
+    if not isinstance(required_values, dict):
+        return
+    for key, value in required_values.items():
+        if key == "_signature":
+            signed = value.get("signed") if isinstance(value, dict) else None
+            if not isinstance(signed, dict):
+                continue
+            if is_indexable_value(signed.get("member", [])):
+                yield (SIGNER_MEMBER_INDEX, signed["member"])
+            if isinstance(signed.get("roles"), list):
+                for role in signed["roles"]:
+                    if is_indexable_value(role):
+                        yield (SIGNER_ROLES_INDEX, role)
+        elif is_indexable_value(value):
+            yield (key, value)
+
+
+def _is_structure(value):
+    return isinstance(value, (dict, list))
+
+
+def is_indexable_value(value):
+    # Only primitive values are indexed, as they're matched by equality
+    return value is None or isinstance(value, (str, int, float))
@@ -2,14 +2,34 @@ import base64
 import json
 import copy
 import datetime
+import functools
+import hashlib
+import itertools
 
-from cryptography.hazmat.primitives import serialization
-
+from .binary import encode_binary
+from .certificates import (
+    certificates_for_record,
+    is_certificate_reference,
+    merge_certificates,
+    reference_certificates,
+)
 from .identifier import globally_unique_step_identifier
+from .instrumentation import NULL_INSTRUMENTATION
+from .steps import VerifiedStep, DecodedSteps, signer_info_dict
+from .query import (
+    CompiledQuery,
+    compile_query,
+    is_indexable_value,
+    SIGNER_MEMBER_INDEX,
+    SIGNER_ROLES_INDEX,
+)
 
 
 CURRENT_CONTAINER_FORMAT_VERSION = 0
 
+# Generous for the serial numbers of certificates
+MAXIMUM_SERIAL_LENGTH = 64
+
 
 class Record:
 
@@ -19,6 +39,11 @@ class Record:
     #   _additional_steps -- array of steps to add to the record
     #   _signed -- whether the record is completely signed
     #   _verified -- whether the record has had signatures verified
+    #   _decoded_steps -- cache of decoded steps, keyed by encoded step
+    #   _record_origins -- origin ids in _record, or None if not yet known
+    #   _additional_record_origins -- origin ids in additional records
+    #   _additional_step_origins -- origin ids in additional steps
+    #   _step_indexes -- indexes of verified steps, built when first queried
 
     def __init__(self, trust_framework, record=None):
         if record is not None:
@@ -34,36 +59,78 @@ class Record:
         self._additional_steps = []
         self._signed = True
         self._verified = None
+        self._decoded_steps = {}
+        self._record_origins = None
+        self._additional_record_origins = []
+        self._additional_step_origins = []
+        self._step_indexes = {}
 
-    def verify(self, certificate_provider):
+    def verify(
+        self, certificate_provider, executor=None, container_cache=None, lazy=False
+    ):
+        # If an executor (eg a concurrent.futures.ThreadPoolExecutor) is given,
+        # the signatures of the containers are verified concurrently.
+        # If a VerifiedContainerCache is given, containers which have already
+        # been verified, along with everything they contain, are not verified
+        # again. Only use a cache with a single certificate provider.
+        # If lazy is True, steps are only decoded for the origins check, then
+        # kept in encoded form until they're accessed, and decoded() returns a
+        # read-only view rather than a copy. find_step() and filter_steps() then
+        # return read-only Mappings, which can be converted with to_dict().
         self._require_signed()
-        # Recursively verify record
-        steps = []
-        origins = []
-        signer_stack = []
+        instrumentation = _instrumentation(certificate_provider)
+        with instrumentation.phase("record.verify"):
+            certificates_from_record = self._certificates_from_record()
+            # Gather the signatures of every container, then verify them all,
+            # then decode the steps with the signer information.
+            with instrumentation.phase("record.verify.containers"):
+                containers = self._containers_for_verification(
+                    container_cache, not _verifies_digests(certificate_provider)
+                )
+            verify_container = functools.partial(
+                _verify_container, certificate_provider, certificates_from_record
+            )
+            with instrumentation.phase("record.verify.signatures"):
+                if executor is None:
+                    signer_infos = list(map(verify_container, containers))
+                else:
+                    signer_infos = list(executor.map(verify_container, containers))
+            with instrumentation.phase("record.verify.decode"):
+                self._complete_verification(
+                    containers, signer_infos, container_cache, lazy
+                )
+        if instrumentation is not NULL_INSTRUMENTATION:
+            self._count_verification(instrumentation, containers, container_cache)
+
+    def _count_verification(self, instrumentation, containers, container_cache):
+        instrumentation.count("record.verify.containers", len(containers))
+        instrumentation.count("record.verify.steps", len(self._verified))
+        instrumentation.count(
+            "record.verify.bytes", _encoded_steps_length(self._record["steps"])
+        )
+        if container_cache is not None:
+            for c in containers:
+                instrumentation.cache(
+                    "record.container_cache", c.cached_signer_infos is not None
+                )
+
+    def _certificates_from_record(self):
         certificates_from_record = self._record.get("certificates")
         if certificates_from_record is None:
             certificates_from_record = {}
-        self._verify_record_container(
-            self._record["steps"],
-            certificates_from_record,
-            certificate_provider,
-            steps,
-            origins,
-            signer_stack,
+        return certificates_from_record
+
+    def _containers_for_verification(self, container_cache=None, include_data=False):
+        # If include_data is True, the data for signing is kept for providers
+        # which don't verify digests
+        containers = []
+        self._gather_record_containers(
+            self._record["steps"], containers, container_cache, include_data
         )
-        if self._record["origins"] != origins:
-            raise Exception("origins property does not match origin steps in record")
-        self._verified = steps
-
-    def _verify_record_container(
-        self,
-        container,
-        certificates_from_record,
-        certificate_provider,
-        steps,
-        origins,
-        signer_stack,
+        return containers
+
+    def _gather_record_containers(
+        self, container, containers, container_cache, include_data
     ):
         *data, sig_block = container
         container_format_version, serial, sign_timestamp, signature = sig_block
@@ -76,39 +143,118 @@ class Record:
         # Serial number must only be a number
         if str(int(serial)) != serial:
             raise Exception("Bad certificate serial number in record: " + serial)
-        # Check signatures at this level and get signer information
-        data_for_signing = self._data_for_signing(
-            data, [str(container_format_version), serial, sign_timestamp]
-        )
-        signer_info = certificate_provider.verify(
-            certificates_from_record,
+        additional = [str(container_format_version), serial, sign_timestamp]
+        if include_data:
+            data_for_signing = self._data_for_signing(data, additional)
+            digest = hashlib.sha256(data_for_signing).digest()
+        else:
+            data_for_signing = None
+            digest = self._digest_for_signing(data, additional)
+        container_signature = _ContainerSignature(
             serial,
             sign_timestamp,
-            data_for_signing.encode("utf-8"),
+            digest,
             base64.urlsafe_b64decode(signature),
         )
+        container_signature.data = data_for_signing
+        index = len(containers)
+        containers.append(container_signature)
+        if container_cache is not None:
+            container_signature.cache_key = container_cache.key(
+                container_signature.digest, container_signature.signature
+            )
+            container_signature.cached_signer_infos = container_cache.get(
+                container_signature.cache_key
+            )
+            if container_signature.cached_signer_infos is not None:
+                # Signer information for nested containers is in the cache too
+                return
+        for e in data:
+            if not isinstance(e, str):
+                self._gather_record_containers(
+                    e, containers, container_cache, include_data
+                )
+        container_signature.container_count = len(containers) - index
+
+    def _complete_verification(
+        self, containers, signer_infos, container_cache=None, lazy=False
+    ):
+        # signer_infos are lists of signer information for each of the containers
+        # returned by _containers_for_verification(), where a container from
+        # the cache gives the signer information of all the containers within it.
+        all_signer_infos = list(itertools.chain.from_iterable(signer_infos))
+        steps = []
+        origins = []
+        signer_stack = []
+        self._decode_record_container(
+            self._record["steps"],
+            iter(all_signer_infos),
+            steps,
+            origins,
+            signer_stack,
+            lazy,
+        )
+        if self._record["origins"] != origins:
+            raise Exception("origins property does not match origin steps in record")
+        self._verified = DecodedSteps(steps) if lazy else steps
+        self._step_indexes = {}
+        self._record_origins = origins
+        if container_cache is not None:
+            self._cache_verified_containers(
+                containers, signer_infos, all_signer_infos, container_cache
+            )
+
+    def _cache_verified_containers(
+        self, containers, signer_infos, all_signer_infos, container_cache
+    ):
+        offsets = list(itertools.accumulate((len(i) for i in signer_infos), initial=0))
+        for index, container_signature in enumerate(containers):
+            if container_signature.cached_signer_infos is None:
+                end_index = index + container_signature.container_count
+                container_cache.put(
+                    container_signature.cache_key,
+                    tuple(all_signer_infos[offsets[index] : offsets[end_index]]),
+                )
+
+    def _decode_record_container(
+        self, container, signer_infos, steps, origins, signer_stack, lazy
+    ):
+        *data, sig_block = container
+        # Lazy steps convert the shared SignerInfo to a plain dict when accessed
+        signed = next(signer_infos)
+        if not lazy:
+            signed = signer_info_dict(signed)
+        # Signature information shared by the steps in this container, and the
+        # signer information shared with the containers within it. Verified
+        # steps are copied before they're returned, so sharing isn't visible.
+        signature = None
         # Recurse into signed data, collecting decoded steps and adding signer info
         for e in data:
             if not isinstance(e, str):
-                signer_stack.append(signer_info)
-                self._verify_record_container(
-                    e,
-                    certificates_from_record,
-                    certificate_provider,
-                    steps,
-                    origins,
-                    signer_stack,
+                signer_stack.append(signed)
+                self._decode_record_container(
+                    e, signer_infos, steps, origins, signer_stack, lazy
                 )
                 del signer_stack[-1]
+                continue
+            if lazy:
+                # Decode without caching to check origins
+                decoded_step = self._decoded_steps.get(e)
+                if decoded_step is None:
+                    decoded_step = json.loads(base64.urlsafe_b64decode(e))
             else:
-                decoded_step = json.loads(base64.urlsafe_b64decode(e))
-                if decoded_step["type"] == "origin":
-                    origins.append(decoded_step["id"])
-                decoded_step["_signature"] = {
-                    "signed": signer_info,
-                    "includedBy": copy.copy(signer_stack),
-                }
-                steps.append(decoded_step)
+                decoded_step = self._decode_step(e)
+            if decoded_step["type"] == "origin":
+                origins.append(decoded_step["id"])
+            if lazy:
+                if signature is None:
+                    signature = {"signed": signed, "includedBy": tuple(signer_stack)}
+                steps.append(VerifiedStep(self, e, signature))
+            else:
+                if signature is None:
+                    signature = {"signed": signed, "includedBy": list(signer_stack)}
+                # Shares values with the cache of decoded steps
+                steps.append({**decoded_step, "_signature": signature})
 
     def add_record(self, record):
         self._signed = False
@@ -118,6 +264,7 @@ class Record:
         if self.trust_framework != record.trust_framework:
             raise Exception("Incompatible trust frameworks in added Record")
         self._additional_records.append(record.encoded())
+        self._additional_record_origins.extend(record._origins())
 
     def add_step(self, step_in):
         self._signed = False
@@ -147,6 +294,8 @@ class Record:
         self._additional_steps.append(
             {"id": id, "timestamp": timestamp, "type": step_type, **step}
         )
+        if step_type == "origin":
+            self._additional_step_origins.append(id)
         return id
 
     def find_step(self, required_values):
@@ -158,53 +307,105 @@ class Record:
         return steps[0]
 
     def filter_steps(self, required_values):
+        # required_values may be a query from compile_query()
         self._require_verified()
-        return list(
-            filter(
-                lambda s: self._filter_step_contains(s, required_values), self._verified
+        query = required_values
+        if not isinstance(query, CompiledQuery):
+            query = compile_query(required_values)
+        steps = list(filter(query.matches, self._candidate_steps(query)))
+        if isinstance(self._verified, DecodedSteps):
+            return steps
+        # Copies, so the verified steps can't be modified
+        return copy.deepcopy(steps)
+
+    def _candidate_steps(self, query):
+        # Use indexes of the top level values of steps and the signer's member
+        # and roles to find the steps which could match the query
+        candidates = None
+        for index_key, index_value in query.index_lookups:
+            positions = self._step_index(index_key).get(index_value, ())
+            if candidates is None:
+                candidates = set(positions)
+            else:
+                candidates.intersection_update(positions)
+            if not candidates:
+                return []
+        if candidates is None:
+            return self._verified
+        return [self._verified[i] for i in sorted(candidates)]
+
+    def _step_index(self, key):
+        index = self._step_indexes.get(key)
+        if index is None:
+            index = {}
+            for position, step in enumerate(self._verified):
+                if key == SIGNER_MEMBER_INDEX:
+                    values = [step["_signature"]["signed"].get("member")]
+                elif key == SIGNER_ROLES_INDEX:
+                    values = step["_signature"]["signed"].get("roles", [])
+                else:
+                    values = [step.get(key, [])]
+                for value in values:
+                    if is_indexable_value(value):
+                        index.setdefault(value, []).append(position)
+            self._step_indexes[key] = index
+        return index
+
+    def sign(self, signer):
+        instrumentation = _instrumentation(signer)
+        with instrumentation.phase("record.sign"):
+            with instrumentation.phase("record.sign.prepare"):
+                signing = self._prepare_signing(signer)
+            signature = _sign(signer, signing[-1])
+            return self._complete_signing(
+                signing, signature, lambda: _certificates_for_record(signer)
             )
-        )
 
-    def _filter_step_contains(self, step, required_values):
-        if isinstance(required_values, dict):
-            # If required_values is a dict, ensure step is a dict and contains all keys/values of required_values
-            if not isinstance(step, dict):
-                return False
-            for key, value in required_values.items():
-                if key not in step or not self._filter_step_contains(step[key], value):
-                    return False
-            return True
-        elif isinstance(required_values, list):
-            # If required_values is a list, ensure step is a list and contains all elements of required_values
-            if not isinstance(step, list):
-                return False
-            for item in required_values:
-                if not any(self._filter_step_contains(x, item) for x in step):
-                    return False
-            return True
+    async def sign_async(self, signer):
+        # signer must implement sign_digest_async() or sign_async(),
+        # eg SignerKMSAsync
+        with _instrumentation(signer).phase("record.sign.prepare"):
+            signing = self._prepare_signing(signer)
+        if hasattr(signer, "sign_digest_async"):
+            signature = await signer.sign_digest_async(signing[-1])
         else:
-            # If required_values is a primitive, ensure it matches the value in step
-            return step == required_values
+            signature = await signer.sign_async(signing[-1])
+        return self._complete_signing(
+            signing, signature, lambda: _certificates_for_record(signer)
+        )
 
-    def sign(self, signer):
+    def _prepare_signing(self, signer):
+        # Returns the state needed by _complete_signing(), with the digest to
+        # sign last, or the data if the signer can't sign digests
+        serial = signer.serial()
         output = []
         certificates = {}
         if self._record is not None:
             if "certificates" in self._record:
-                certificates.update(self._record["certificates"])
+                merge_certificates(certificates, self._record["certificates"])
             output.append(self._record["steps"])  # signed and encoded
         for r in self._additional_records:
             if "certificates" in r:
-                certificates.update(r["certificates"])
+                merge_certificates(certificates, r["certificates"])
             output.append(r["steps"])  # signed and encoded
         for s in self._additional_steps:
             output.append(self._encode_step(s))  # unencoded, not signed
-        serial = signer.serial()
+        instrumentation = _instrumentation(signer)
+        instrumentation.count("record.sign.steps", len(self._additional_steps))
         sign_timestamp = self._timestamp_now_iso8601()
-        data_for_signing = self._data_for_signing(
-            output, [str(CURRENT_CONTAINER_FORMAT_VERSION), serial, sign_timestamp]
-        )
-        signature = signer.sign(data_for_signing.encode("utf-8"))
+        additional = [str(CURRENT_CONTAINER_FORMAT_VERSION), serial, sign_timestamp]
+        if _signs_digests(signer):
+            to_sign, length = self._digest_and_length_for_signing(output, additional)
+        else:
+            to_sign = self._data_for_signing(output, additional)
+            length = len(to_sign)
+        instrumentation.count("record.sign.bytes", length)
+        return (output, certificates, serial, sign_timestamp, to_sign)
+
+    def _complete_signing(self, signing, signature, certificates_for_record):
+        # certificates_for_record is a function returning the certificates
+        # to merge into the record for the signer, or None
+        output, certificates, serial, sign_timestamp, to_sign = signing
         output.append(
             [
                 CURRENT_CONTAINER_FORMAT_VERSION,
@@ -213,30 +414,61 @@ class Record:
                 base64.urlsafe_b64encode(signature).decode("utf-8"),
             ]
         )
-        if serial not in certificates:
-            certs_for_record = signer.certificates_for_record()
-            if certs_for_record is not None:
-                # Represent path as [pem encoded cert, serials of issuer chain ...]
-                first_cert, *other_certs = certs_for_record
-                cert_path = [
-                    first_cert.public_bytes(serialization.Encoding.PEM).decode("utf-8")
-                ]
-                cert_path.extend(list(map(lambda c: str(c.serial_number), other_certs)))
-                certificates[serial] = cert_path
-                for c in other_certs:
-                    certificates[str(c.serial_number)] = [
-                        c.public_bytes(serialization.Encoding.PEM).decode("utf-8")
-                    ]
+        if serial not in certificates or is_certificate_reference(
+            certificates[serial][0]
+        ):
+            signer_certificates = certificates_for_record()
+            if signer_certificates is not None:
+                merge_certificates(certificates, signer_certificates)
+        # Origins are in the same order as the steps in the output
         origins = []
-        self._gather_origins(output, origins)
+        if self._record is not None:
+            origins.extend(self._origins())
+        origins.extend(self._additional_record_origins)
+        origins.extend(self._additional_step_origins)
         encoded = {
             "ib1:provenance": self.trust_framework,
             "origins": origins,
-            "steps": copy.deepcopy(output),
         }
+        # Certificates precede the steps so records can be verified as a stream
         if certificates:
             encoded["certificates"] = certificates
-        return Record(self.trust_framework, encoded)
+        encoded["steps"] = self._copy_container(output)
+        signed_record = Record(self.trust_framework, encoded)
+        signed_record._record_origins = origins.copy()
+        return signed_record
+
+    def signatures(self):
+        # (serial, sign_timestamp) of every container, in the order verify()
+        # checks them, without decoding steps or checking signatures. Can be
+        # used to fetch certificates or reject unknown signers before verifying,
+        # eg with the certificate provider's prefetch_record().
+        self._require_signed()
+        signatures = []
+        self._gather_signatures(self._record["steps"], signatures)
+        return signatures
+
+    def _gather_signatures(self, container, signatures):
+        if not (isinstance(container, list) and container):
+            raise Exception("Bad container in record")
+        sig_block = container[-1]
+        if not (isinstance(sig_block, list) and len(sig_block) == 4):
+            raise Exception("Bad signature block in record")
+        serial = sig_block[1]
+        if not is_serial(serial):
+            raise Exception("Bad certificate serial number in record: " + str(serial))
+        signatures.append((serial, sig_block[2]))
+        for e in container[:-1]:
+            if not isinstance(e, str):
+                self._gather_signatures(e, signatures)
+
+    def _origins(self):
+        # Origin ids of the signed record, only decoding steps if not already known
+        if self._record_origins is None:
+            origins = []
+            self._gather_origins(self._record["steps"], origins)
+            self._record_origins = origins
+        return self._record_origins
 
     def _gather_origins(self, container, origins):
         *data, sig_block = container
@@ -244,38 +476,107 @@ class Record:
             if not isinstance(e, str):
                 self._gather_origins(e, origins)
             else:
-                decoded_step = json.loads(base64.urlsafe_b64decode(e))
+                decoded_step = self._decode_step(e)
                 if decoded_step["type"] == "origin":
                     origins.append(decoded_step["id"])
 
+    def _decode_step(self, encoded_step):
+        # Decoded steps are cached, so must not be modified or returned
+        # without copying
+        decoded_step = self._decoded_steps.get(encoded_step)
+        if decoded_step is None:
+            decoded_step = json.loads(base64.urlsafe_b64decode(encoded_step))
+            self._decoded_steps[encoded_step] = decoded_step
+        return decoded_step
+
+    def _copy_container(self, container):
+        # Equivalent to deepcopy for containers of strings and ints, but much faster
+        return [
+            self._copy_container(e) if isinstance(e, list) else e for e in container
+        ]
+
     def _encode_step(self, step):
         return base64.urlsafe_b64encode(
             json.dumps(step, separators=(",", ":")).encode("utf-8")
         ).decode("utf-8")
 
-    def _data_for_signing(self, data, additional=None, is_root=True):
-        gather = []
-        if is_root:
-            gather.append(self.trust_framework)
+    def _data_for_signing(self, data, additional=None):
+        return ".".join(self._data_for_signing_tokens(data, additional)).encode(
+            "utf-8"
+        )
+
+    def _digest_for_signing(self, data, additional=None):
+        return self._digest_and_length_for_signing(data, additional)[0]
+
+    def _digest_and_length_for_signing(self, data, additional=None):
+        # SHA-256 digest and length of _data_for_signing(), without creating the
+        # data
+        hasher = hashlib.sha256()
+        tokens = iter(self._data_for_signing_tokens(data, additional))
+        encoded_token = next(tokens).encode("utf-8")
+        hasher.update(encoded_token)
+        length = len(encoded_token)
+        for token in tokens:
+            encoded_token = token.encode("utf-8")
+            hasher.update(b".")
+            hasher.update(encoded_token)
+            length += 1 + len(encoded_token)
+        return hasher.digest(), length
+
+    def _data_for_signing_tokens(self, data, additional=None):
+        # Canonical form of the data is the trust framework, the elements of the
+        # data, and the additional elements, separated by ".", with nested
+        # containers in the data represented as "%" + contents + "&". The tokens
+        # are gathered into a flat list so the string is only joined once, if
+        # at all.
+        tokens = [self.trust_framework]
+        self._gather_data_for_signing_tokens(data, tokens)
+        if additional is not None:
+            tokens.extend(additional)
+        return tokens
+
+    def _gather_data_for_signing_tokens(self, data, tokens):
         for e in data:
             if isinstance(e, str):
-                gather.append(e)
+                tokens.append(e)
             elif isinstance(e, int):
-                gather.append(str(e))
+                tokens.append(str(e))
             else:
-                gather.append("%")
-                gather.append(self._data_for_signing(e, None, False))
-                gather.append("&")
-        if additional is not None:
-            gather.extend(additional)
-        return ".".join(gather)
+                tokens.append("%")
+                if e:
+                    self._gather_data_for_signing_tokens(e, tokens)
+                else:
+                    tokens.append("")  # empty container is an empty string
+                tokens.append("&")
 
     def encoded(self):  # TODO name
         self._require_signed()
         return self._record
 
+    def encoded_with_certificate_references(self, references):
+        # encoded(), with the certificates whose references are in references
+        # (eg a CertificateBundle of the certificates the receiver has) replaced
+        # by references, to make records smaller
+        self._require_signed()
+        if "certificates" not in self._record:
+            return self._record
+        return {
+            **self._record,
+            "certificates": reference_certificates(
+                self._record["certificates"], references
+            ),
+        }
+
+    def encoded_binary(self):
+        # Compact binary form of encoded(), see decode_binary()
+        self._require_signed()
+        return encode_binary(self._record)
+
     def decoded(self):  # TODO name
         self._require_verified()
+        if isinstance(self._verified, DecodedSteps):
+            return self._verified
+        # deepcopy keeps signer information shared between steps
         return copy.deepcopy(self._verified)
 
     def _require_signed(self):
@@ -344,3 +645,110 @@ class Record:
             dot.append("  }")
         dot.append("}")
         return "\n".join(dot)
+
+
+def is_serial(serial):
+    # Canonical decimal integer, as checked by verify()
+    return (
+        isinstance(serial, str)
+        and 0 < len(serial) <= MAXIMUM_SERIAL_LENGTH
+        and serial.isascii()
+        and serial.isdigit()
+        and (serial == "0" or serial[0] != "0")
+    )
+
+
+def _instrumentation(provider_or_signer):
+    return getattr(provider_or_signer, "instrumentation", NULL_INSTRUMENTATION)
+
+
+def _encoded_steps_length(container):
+    length = 0
+    for e in container:
+        if isinstance(e, str):
+            length += len(e)
+        elif e and not isinstance(e[0], int):
+            length += _encoded_steps_length(e)
+    return length
+
+
+def _signs_digests(signer):
+    return hasattr(signer, "sign_digest") or hasattr(signer, "sign_digest_async")
+
+
+def _verifies_digests(certificate_provider):
+    # Providers which override verify() without overriding verify_digest(), eg
+    # to add checks, are given the data so their verify() is used
+    for cls in type(certificate_provider).__mro__:
+        if "verify_digest" in cls.__dict__:
+            return True
+        if "verify" in cls.__dict__:
+            return False
+    return hasattr(certificate_provider, "verify_digest")
+
+
+def _sign(signer, to_sign):
+    # to_sign is from _prepare_signing()
+    if hasattr(signer, "sign_digest"):
+        return signer.sign_digest(to_sign)
+    return signer.sign(to_sign)
+
+
+def _certificates_for_record(signer):
+    # Signers may provide the certificates already encoded for the record
+    if hasattr(signer, "encoded_certificates_for_record"):
+        return signer.encoded_certificates_for_record()
+    certs_for_record = signer.certificates_for_record()
+    if certs_for_record is None:
+        return None
+    return certificates_for_record(certs_for_record)
+
+
+class _ContainerSignature:
+    # Signature of a container within a record, gathered for verification
+    __slots__ = (
+        "serial",
+        "sign_timestamp",
+        "digest",
+        "data",
+        "signature",
+        "cache_key",
+        "cached_signer_infos",
+        "container_count",
+    )
+
+    def __init__(self, serial, sign_timestamp, digest, signature):
+        self.serial = serial
+        self.sign_timestamp = sign_timestamp
+        self.digest = digest
+        self.data = None
+        self.signature = signature
+        self.cache_key = None
+        self.cached_signer_infos = None
+        self.container_count = 1
+
+
+def _verify_container(certificate_provider, certificates_from_record, container):
+    # Returns the signer information for the container, and if it was found in
+    # the verified container cache, for every container nested within it.
+    if container.cached_signer_infos is not None:
+        return container.cached_signer_infos
+    if container.data is not None:
+        return (
+            certificate_provider.verify(
+                certificates_from_record,
+                container.serial,
+                container.sign_timestamp,
+                container.data,
+                container.signature,
+            ),
+        )
+    return (
+        certificate_provider.verify_digest(
+            certificates_from_record,
+            container.serial,
+            container.sign_timestamp,
+            container.digest,
+            container.signature,
+        ),
+    )
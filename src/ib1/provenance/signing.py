@@ -1,11 +1,19 @@
+import asyncio
 import importlib.util
 import hashlib
+import inspect
+import random
+import threading
+import time
+import weakref
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import ec, utils
 
 from ib1.provenance.certificates import CertificateProviderBase as CertificateProvider
+from ib1.provenance.certificates import certificates_for_record
+from ib1.provenance.instrumentation import NULL_INSTRUMENTATION
 
 
 class SignerInMemory:
@@ -14,10 +22,16 @@ class SignerInMemory:
         certificate_provider: CertificateProvider,
         certificates: list[x509.Certificate],
         private_key=None,
+        instrumentation=None,
     ):
         self._certificate_provider = certificate_provider
         self._certificates = certificates
         self._private_key = private_key
+        # Defaults to the provider's, and also used by Record when signing
+        self.instrumentation = instrumentation or getattr(
+            certificate_provider, "instrumentation", NULL_INSTRUMENTATION
+        )
+        self._encoded_certificates_for_record = None
 
     def serial(self):
         return str(
@@ -29,9 +43,29 @@ class SignerInMemory:
             return None
         return self._certificates.copy()
 
+    def encoded_certificates_for_record(self):
+        # Certificates to merge into the certificates property of a record. The
+        # returned dict is shared, and must not be modified.
+        if not self._certificate_provider.policy_include_certificates_in_record:
+            return None
+        # The chain never changes, so is encoded for records once
+        if self._encoded_certificates_for_record is None:
+            self._encoded_certificates_for_record = certificates_for_record(
+                self._certificates
+            )
+        return self._encoded_certificates_for_record
+
     def sign(self, data):
         # TODO: Use correct algorithm for type of key in certificate, assuming EC crypto
-        return self._private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+        with self.instrumentation.phase("signer.sign"):
+            return self._private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+    def sign_digest(self, digest):
+        # Sign the SHA-256 digest of the data, so the data doesn't need to be in memory
+        with self.instrumentation.phase("signer.sign"):
+            return self._private_key.sign(
+                digest, ec.ECDSA(utils.Prehashed(hashes.SHA256()))
+            )
 
 
 class SignerFiles(SignerInMemory):
@@ -68,11 +102,104 @@ class SignerKMS(SignerInMemory):
         # AWS KMS has a 4096 byte limit for MessageType="RAW"
         # For larger messages, we need to hash first and use MessageType="DIGEST"
         # Hash the data using SHA-256 (matching the ECDSA_SHA_256 signing algorithm)
-        digest = hashlib.sha256(data).digest()
-        resp = self._kms_client.sign(
-            KeyId=self._key_id,
-            Message=digest,
-            MessageType="DIGEST",
-            SigningAlgorithm="ECDSA_SHA_256",
-        )
+        return self.sign_digest(hashlib.sha256(data).digest())
+
+    def sign_digest(self, digest):
+        with self.instrumentation.phase("signer.sign"):
+            resp = self._kms_client.sign(
+                KeyId=self._key_id,
+                Message=digest,
+                MessageType="DIGEST",
+                SigningAlgorithm="ECDSA_SHA_256",
+            )
         return resp["Signature"]
+
+
+class SignerKMSAsync(SignerKMS):
+    # SignerKMS with an asyncio interface, sign_async(), for use with
+    # Record.sign_async(). kms_client may be a boto3 client, where calls are
+    # made in the event loop's default executor, or a client with a coroutine
+    # sign() method. At most max_in_flight requests are made concurrently in
+    # each event loop the signer is used with, and throttled requests are
+    # retried with exponential backoff. If given,
+    # latency_callback is called with the duration in seconds of each request.
+
+    THROTTLING_ERROR_CODES = (
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "TooManyRequestsException",
+    )
+
+    def __init__(
+        self,
+        certificate_provider: CertificateProvider,
+        certificates: list[x509.Certificate],
+        kms_client,
+        key_id,
+        max_in_flight=16,
+        max_retries=5,
+        initial_backoff=0.05,
+        latency_callback=None,
+    ):
+        super().__init__(certificate_provider, certificates, kms_client, key_id)
+        self._max_in_flight = max_in_flight
+        # asyncio.Semaphore is bound to an event loop, so one for each loop
+        self._in_flight = weakref.WeakKeyDictionary()
+        self._in_flight_lock = threading.Lock()
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._latency_callback = latency_callback
+
+    async def sign_async(self, data):
+        return await self.sign_digest_async(hashlib.sha256(data).digest())
+
+    async def sign_digest_async(self, digest):
+        attempt = 0
+        while True:
+            try:
+                async with self._in_flight_semaphore():
+                    resp = await self._kms_sign(digest)
+                return resp["Signature"]
+            except Exception as e:
+                if attempt >= self._max_retries or not self._is_throttling_error(e):
+                    raise
+            # Full jitter, so concurrent requests don't retry in step
+            await asyncio.sleep(random.uniform(0, self._initial_backoff * (2**attempt)))
+            attempt += 1
+
+    def _in_flight_semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self._in_flight_lock:
+            semaphore = self._in_flight.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self._max_in_flight)
+                self._in_flight[loop] = semaphore
+        return semaphore
+
+    async def _kms_sign(self, digest):
+        kwargs = {
+            "KeyId": self._key_id,
+            "Message": digest,
+            "MessageType": "DIGEST",
+            "SigningAlgorithm": "ECDSA_SHA_256",
+        }
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(self._kms_client.sign):
+                return await self._kms_client.sign(**kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, lambda: self._kms_client.sign(**kwargs)
+            )
+        finally:
+            latency = time.perf_counter() - start
+            self.instrumentation.duration("signer.sign", latency)
+            if self._latency_callback is not None:
+                self._latency_callback(latency)
+
+    def _is_throttling_error(self, e):
+        # botocore's ClientError has the error code in the response
+        response = getattr(e, "response", None)
+        if not isinstance(response, dict):
+            return False
+        return response.get("Error", {}).get("Code") in self.THROTTLING_ERROR_CODES
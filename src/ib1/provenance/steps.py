@@ -0,0 +1,94 @@
+from collections.abc import Mapping, Sequence
+
+
+class VerifiedStep(Mapping):
+    # Read-only step of a Record verified with lazy=True, kept in encoded form
+    # until a key other than _signature is accessed. The decoded step is shared
+    # with the Record's cache of decoded steps, and the signer information
+    # with every step in the container and the certificate provider. Values
+    # are copied to plain dicts and lists when accessed, so the shared objects
+    # can't be modified.
+
+    __slots__ = ("_record", "_encoded", "_signature", "_step")
+
+    def __init__(self, record, encoded, signature):
+        self._record = record
+        self._encoded = encoded
+        # {"signed": SignerInfo, "includedBy": tuple of SignerInfo}
+        self._signature = signature
+        self._step = None
+
+    def _decoded(self):
+        if self._step is None:
+            self._step = self._record._decode_step(self._encoded)
+        return self._step
+
+    def __getitem__(self, key):
+        if key == "_signature":
+            return {
+                "signed": signer_info_dict(self._signature["signed"]),
+                "includedBy": [
+                    signer_info_dict(i) for i in self._signature["includedBy"]
+                ],
+            }
+        return copy_value(self._decoded()[key])
+
+    def __contains__(self, key):
+        return key == "_signature" or key in self._decoded()
+
+    def __iter__(self):
+        yield from self._decoded()
+        yield "_signature"
+
+    def __len__(self):
+        return len(self._decoded()) + 1
+
+    def to_dict(self):
+        # Independent copy of the step as a dict, as returned by decoded()
+        step = copy_value(self._decoded())
+        step["_signature"] = self["_signature"]
+        return step
+
+    def __repr__(self):
+        return "VerifiedStep(" + repr(self._encoded) + ")"
+
+
+class DecodedSteps(Sequence):
+    # Read-only view of the verified steps of a Record, returned by decoded()
+    # for records verified with lazy=True.
+
+    __slots__ = ("_steps",)
+
+    def __init__(self, steps):
+        self._steps = steps
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DecodedSteps(self._steps[index])
+        return self._steps[index]
+
+    def __len__(self):
+        return len(self._steps)
+
+    def to_list(self):
+        # Decodes every step, returning the same structure as decoded() for a
+        # Record verified without lazy=True, eg for JSON encoding
+        return [s.to_dict() for s in self._steps]
+
+
+def signer_info_dict(signer_info):
+    # Plain dict of signer information returned by a certificate provider,
+    # which may be an immutable SignerInfo with roles as a tuple
+    signer_info = dict(signer_info)
+    if "roles" in signer_info:
+        signer_info["roles"] = list(signer_info["roles"])
+    return signer_info
+
+
+def copy_value(value):
+    # Equivalent to deepcopy for decoded JSON values, but much faster
+    if isinstance(value, dict):
+        return {k: copy_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_value(v) for v in value]
+    return value
@@ -0,0 +1,353 @@
+import base64
+import codecs
+import hashlib
+import json
+
+from .record import CURRENT_CONTAINER_FORMAT_VERSION, _verifies_digests
+from .steps import signer_info_dict
+
+# Verification of encoded records read incrementally from a file or socket,
+# for records too large to hold in memory. Each container is verified as soon
+# as it has been read, and its steps are then yielded, so memory use is bounded
+# by the steps of the containers which are still open rather than the size of
+# the record.
+
+
+def verify_stream(source, trust_framework, certificate_provider, chunk_size=65536):
+    # Generator of verified, decoded steps from an encoded record read from
+    # source, a file-like object with a read() method returning str or bytes.
+    #
+    # Steps are yielded in the order their containers are completed, which is
+    # the order of decoded() for records created by Record.sign(). Each step
+    # has a _signature with the signer, and an includedBy list which is only
+    # complete once the generator is exhausted, as the containers including a
+    # step are verified after it.
+    #
+    # An exception may be raised after some steps have been yielded, in which
+    # case the record is not valid and the steps yielded must be discarded.
+    #
+    # Self-contained records with the certificates after the steps are verified
+    # once the certificates have been read, keeping every step in memory.
+    verifier = _StreamVerifier(
+        _JSONReader(source, chunk_size), trust_framework, certificate_provider
+    )
+    yield from verifier.verify()
+
+
+class _StreamVerifier:
+    def __init__(self, reader, trust_framework, certificate_provider):
+        self._reader = reader
+        self._trust_framework = trust_framework
+        self._certificate_provider = certificate_provider
+        # Providers which don't verify digests are given the data, which is kept
+        # for each open container
+        self._include_data = not _verifies_digests(certificate_provider)
+        self._certificates = None
+        if not certificate_provider.policy_include_certificates_in_record:
+            self._certificates = {}
+        self._record_origins = None
+        self._origins = []
+        self._open = []  # containers currently being read, outermost first
+        self._deferred = []  # completed containers waiting for certificates
+
+    def verify(self):
+        reader = self._reader
+        reader.expect("{")
+        seen_steps = False
+        while not reader.consume("}"):
+            key = reader.read_string()
+            reader.expect(":")
+            if key == "steps":
+                if seen_steps:
+                    raise Exception("Record contains more than one steps property")
+                seen_steps = True
+                yield from self._read_container()
+            elif key == "certificates":
+                certificates = reader.read_value()
+                if not isinstance(certificates, dict):
+                    raise Exception("Bad certificates property in record")
+                if self._certificates is None:
+                    self._certificates = certificates
+                yield from self._verify_deferred()
+            elif key == "origins":
+                self._record_origins = reader.read_value()
+            elif key == "ib1:provenance":
+                if reader.read_value() != self._trust_framework:
+                    raise Exception(
+                        "Unexpected trust framework when verifying encoded record"
+                    )
+            else:
+                reader.read_value()
+            if not reader.consume(","):
+                reader.expect("}")
+                break
+        reader.expect_end()
+        if not seen_steps:
+            raise Exception("Not an encoded Provenance record")
+        if self._certificates is None:
+            self._certificates = {}
+            yield from self._verify_deferred()
+        if self._record_origins != self._origins:
+            raise Exception("origins property does not match origin steps in record")
+
+    def _read_container(self):
+        # Reads a container from the reader, yielding steps when verified
+        reader = self._reader
+        reader.expect("[")
+        container = _StreamContainer(self._trust_framework, self._include_data)
+        parent = self._open[-1] if self._open else None
+        if parent is not None:
+            self._update_hashes("%", len(self._open))
+        self._open.append(container)
+        while True:
+            if reader.peek() == "[":
+                if reader.peek_array_starts_with_number():
+                    sig_block = reader.read_value()
+                    if not reader.consume("]"):
+                        raise Exception("Signature block is not last in container")
+                    break
+                yield from self._read_container()
+            else:
+                encoded_step = reader.read_string()
+                self._update_hashes(encoded_step, len(self._open))
+                decoded_step = json.loads(base64.urlsafe_b64decode(encoded_step))
+                if decoded_step["type"] == "origin":
+                    self._origins.append(decoded_step["id"])
+                container.steps.append(decoded_step)
+            if not reader.consume(","):
+                raise Exception("Container does not end with a signature block")
+        container_format_version, serial, sign_timestamp, signature = sig_block
+        if container_format_version != CURRENT_CONTAINER_FORMAT_VERSION:
+            raise Exception(
+                "Cannot decode container format version: "
+                + str(container_format_version)
+            )
+        if str(int(serial)) != serial:
+            raise Exception("Bad certificate serial number in record: " + serial)
+        sig_block_tokens = [str(container_format_version), serial, sign_timestamp]
+        for token in sig_block_tokens:
+            container.update(token)
+        del self._open[-1]
+        if parent is not None:
+            # Including containers sign the whole signature block, as a list
+            sig_block_tokens.append(signature)
+            for token in ["%"] + sig_block_tokens + ["&", "&"]:
+                self._update_hashes(token, len(self._open))
+            parent.descendants.extend(container.descendants)
+            parent.descendants.append(container)
+        container.serial = serial
+        container.sign_timestamp = sign_timestamp
+        container.signature = base64.urlsafe_b64decode(signature)
+        if self._certificates is None or self._deferred:
+            self._deferred.append(container)
+        else:
+            yield from self._verify_container(container)
+
+    def _update_hashes(self, token, depth):
+        for container in self._open[:depth]:
+            container.update(token)
+
+    def _verify_container(self, container):
+        if container.data is not None:
+            signer_info = self._certificate_provider.verify(
+                self._certificates,
+                container.serial,
+                container.sign_timestamp,
+                "".join(container.data).encode("utf-8"),
+                container.signature,
+            )
+        else:
+            signer_info = self._certificate_provider.verify_digest(
+                self._certificates,
+                container.serial,
+                container.sign_timestamp,
+                container.hasher.digest(),
+                container.signature,
+            )
+        signer_info = signer_info_dict(signer_info)
+        for descendant in container.descendants:
+            descendant.included_by.insert(0, signer_info)
+        signature_info = {"signed": signer_info, "includedBy": container.included_by}
+        steps = container.steps
+        container.steps = None
+        container.descendants = None
+        for step in steps:
+            step["_signature"] = signature_info
+            yield step
+
+    def _verify_deferred(self):
+        deferred = self._deferred
+        self._deferred = []
+        for container in deferred:
+            yield from self._verify_container(container)
+
+
+class _StreamContainer:
+    __slots__ = (
+        "hasher",
+        "data",
+        "steps",
+        "descendants",
+        "included_by",
+        "serial",
+        "sign_timestamp",
+        "signature",
+    )
+
+    def __init__(self, trust_framework, include_data):
+        self.hasher = hashlib.sha256(trust_framework.encode("utf-8"))
+        self.data = [trust_framework] if include_data else None
+        self.steps = []
+        self.descendants = []
+        self.included_by = []
+
+    def update(self, token):
+        self.hasher.update(b".")
+        self.hasher.update(token.encode("utf-8"))
+        if self.data is not None:
+            self.data.append(".")
+            self.data.append(token)
+
+
+class _JSONReader:
+    # Minimal pull parser for JSON read in chunks. Individual values (including
+    # encoded steps) must fit in memory, but documents do not.
+
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, source, chunk_size):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._decoder = None
+        self._buffer = ""
+        self._position = 0
+        self._eof = False
+
+    def _fill(self):
+        # Read another chunk, returning False at the end of the input
+        if self._eof:
+            return False
+        chunk = self._source.read(self._chunk_size)
+        if isinstance(chunk, bytes):
+            if self._decoder is None:
+                self._decoder = codecs.getincrementaldecoder("utf-8")()
+            chunk = self._decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._position :] + chunk
+        self._position = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            buffer = self._buffer
+            position = self._position
+            while position < len(buffer) and buffer[position] in self.WHITESPACE:
+                position += 1
+            self._position = position
+            if position < len(buffer) or not self._fill():
+                return
+
+    def peek(self):
+        self._skip_whitespace()
+        if self._position >= len(self._buffer):
+            raise Exception("Unexpected end of encoded record")
+        return self._buffer[self._position]
+
+    def consume(self, character):
+        self._skip_whitespace()
+        if (
+            self._position < len(self._buffer)
+            and self._buffer[self._position] == character
+        ):
+            self._position += 1
+            return True
+        return False
+
+    def expect(self, character):
+        if not self.consume(character):
+            raise Exception("Expected '" + character + "' in encoded record")
+
+    def expect_end(self):
+        self._skip_whitespace()
+        if self._position < len(self._buffer):
+            raise Exception("Unexpected data after encoded record")
+
+    def peek_array_starts_with_number(self):
+        # At the start of an array, is the first element a number?
+        position = self._position + 1
+        while True:
+            buffer = self._buffer
+            while position < len(buffer) and buffer[position] in self.WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                return buffer[position] in "-0123456789"
+            position -= self._position
+            if not self._fill():
+                return False
+            position += self._position
+
+    def read_string(self):
+        if self.peek() != '"':
+            raise Exception("Expected string in encoded record")
+        # Find the closing quote before decoding, without rescanning on refill
+        search = self._position + 1
+        while True:
+            end = self._buffer.find('"', search)
+            if end == -1:
+                search = len(self._buffer) - self._position
+                if not self._fill():
+                    raise Exception("Unexpected end of encoded record")
+                search += self._position
+                continue
+            backslashes = 0
+            while self._buffer[end - 1 - backslashes] == "\\":
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            search = end + 1
+        value, self._position = json.decoder.scanstring(
+            self._buffer, self._position + 1
+        )
+        return value
+
+    def read_value(self):
+        character = self.peek()
+        if character == '"':
+            return self.read_string()
+        elif character == "{":
+            self._position += 1
+            value = {}
+            while not self.consume("}"):
+                key = self.read_string()
+                self.expect(":")
+                value[key] = self.read_value()
+                if not self.consume(","):
+                    self.expect("}")
+                    break
+            return value
+        elif character == "[":
+            self._position += 1
+            value = []
+            while not self.consume("]"):
+                value.append(self.read_value())
+                if not self.consume(","):
+                    self.expect("]")
+                    break
+            return value
+        else:
+            # Number or literal, which ends at a delimiter
+            while True:
+                end = self._position
+                buffer = self._buffer
+                while end < len(buffer) and buffer[end] not in ",]}" + self.WHITESPACE:
+                    end += 1
+                if end < len(buffer) or not self._fill():
+                    break
+            token = self._buffer[self._position : end]
+            self._position = end
+            try:
+                return json.loads(token)
+            except ValueError:
+                raise Exception("Bad value in encoded record: " + token[:32])
@@ -0,0 +1,125 @@
+from .record import CURRENT_CONTAINER_FORMAT_VERSION, is_serial
+
+# Checks of the structure of encoded records against limits, without decoding
+# steps or verifying signatures, so that malformed or oversized records from
+# untrusted sources are rejected before any expensive work is done. Containers
+# are walked iteratively, so deeply nested input can't exhaust the stack.
+
+# Lengths of signature block values, generous for the formats used
+MAXIMUM_TIMESTAMP_LENGTH = 64
+MAXIMUM_SIGNATURE_LENGTH = 256
+
+
+class RecordLimits:
+    def __init__(
+        self,
+        maximum_depth=32,
+        maximum_containers=1024,
+        maximum_steps=10000,
+        maximum_step_size=65536,
+        maximum_certificates=64,
+        maximum_certificate_size=16384,
+    ):
+        self.maximum_depth = maximum_depth
+        self.maximum_containers = maximum_containers
+        self.maximum_steps = maximum_steps
+        self.maximum_step_size = maximum_step_size
+        self.maximum_certificates = maximum_certificates
+        self.maximum_certificate_size = maximum_certificate_size
+
+
+DEFAULT_LIMITS = RecordLimits()
+
+
+def validate_record(encoded, limits=None):
+    # Raises an exception if the encoded record is malformed or exceeds the
+    # limits. A valid structure doesn't mean the record is valid; it must
+    # still be verified.
+    if limits is None:
+        limits = DEFAULT_LIMITS
+    if not isinstance(encoded, dict):
+        raise Exception("Not an encoded Provenance record")
+    if not isinstance(encoded.get("ib1:provenance"), str):
+        raise Exception("Not an encoded Provenance record")
+    origins = encoded.get("origins")
+    if not isinstance(origins, list):
+        raise Exception("Record does not have an origins property")
+    if len(origins) > limits.maximum_steps:
+        raise Exception("Record exceeds maximum number of steps")
+    for origin in origins:
+        if not isinstance(origin, str):
+            raise Exception("Bad origin in record")
+    if "certificates" in encoded:
+        _validate_certificates(encoded["certificates"], limits)
+    _validate_containers(encoded.get("steps"), limits)
+
+
+def _validate_certificates(certificates, limits):
+    if not isinstance(certificates, dict):
+        raise Exception("Bad certificates property in record")
+    if len(certificates) > limits.maximum_certificates:
+        raise Exception("Record exceeds maximum number of certificates")
+    for serial, certs in certificates.items():
+        if not is_serial(serial):
+            raise Exception("Bad certificate serial number in record")
+        if not (isinstance(certs, list) and certs):
+            raise Exception("Bad certificates for serial " + serial)
+        certificate, *path_serials = certs
+        if not isinstance(certificate, str):
+            raise Exception("Bad certificates for serial " + serial)
+        if len(certificate) > limits.maximum_certificate_size:
+            raise Exception("Record exceeds maximum certificate size")
+        if len(path_serials) > limits.maximum_certificates:
+            raise Exception("Record exceeds maximum number of certificates")
+        for path_serial in path_serials:
+            if not is_serial(path_serial):
+                raise Exception("Bad certificates for serial " + serial)
+
+
+def _validate_containers(steps, limits):
+    container_count = 0
+    step_count = 0
+    # (container, depth) of containers still to be checked
+    pending = [(steps, 1)]
+    while pending:
+        container, depth = pending.pop()
+        if depth > limits.maximum_depth:
+            raise Exception("Record exceeds maximum container depth")
+        container_count += 1
+        if container_count > limits.maximum_containers:
+            raise Exception("Record exceeds maximum number of containers")
+        if not (isinstance(container, list) and container):
+            raise Exception("Bad container in record")
+        _validate_signature_block(container[-1])
+        for index in range(len(container) - 1):
+            e = container[index]
+            if isinstance(e, str):
+                step_count += 1
+                if step_count > limits.maximum_steps:
+                    raise Exception("Record exceeds maximum number of steps")
+                if len(e) > limits.maximum_step_size:
+                    raise Exception("Record exceeds maximum step size")
+            elif isinstance(e, list):
+                pending.append((e, depth + 1))
+            else:
+                raise Exception("Bad element in container in record")
+
+
+def _validate_signature_block(sig_block):
+    if not (isinstance(sig_block, list) and len(sig_block) == 4):
+        raise Exception("Bad signature block in record")
+    container_format_version, serial, sign_timestamp, signature = sig_block
+    if (
+        type(container_format_version) is not int
+        or container_format_version != CURRENT_CONTAINER_FORMAT_VERSION
+    ):
+        raise Exception("Cannot decode container format version in record")
+    if not is_serial(serial):
+        raise Exception("Bad certificate serial number in record")
+    if not (
+        isinstance(sign_timestamp, str)
+        and len(sign_timestamp) <= MAXIMUM_TIMESTAMP_LENGTH
+    ):
+        raise Exception("Bad signature timestamp in record")
+    if not (isinstance(signature, str) and len(signature) <= MAXIMUM_SIGNATURE_LENGTH):
+        raise Exception("Bad signature in record")
@@ -0,0 +1,233 @@
+import datetime
+
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtensionOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+import asn1crypto.core as asn1
+
+from ib1.provenance import Record
+from ib1.provenance.certificates import (
+    OID_IB1_ROLES,
+    OID_IB1_MEMBER,
+    CertExtUTF8Sequence,
+    CertificatesProviderLocal,
+    CertificatesProviderSelfContainedRecord,
+)
+from ib1.provenance.signing import SignerInMemory
+
+TRUST_FRAMEWORK_URL = "https://registry.core.trust.ib1.org/trust-framework"
+SCHEME = "https://registry.core.trust.ib1.org/scheme/perseus"
+CAP_MEMBER = "https://directory.core.trust.ib1.org/member/81524"
+BANK_MEMBER = "https://directory.core.trust.ib1.org/member/71212388"
+
+# Mirrors the hierarchy created by scripts/certmaker.sh, but generated in memory
+# so the certificates are always valid when the tests run.
+MEMBERS = {
+    "edp": (
+        123456,
+        "Smart Meter Reading Co",
+        "https://directory.core.trust.ib1.org/application/38936455",
+        "https://directory.core.trust.ib1.org/member/2876152",
+        ["https://registry.core.trust.ib1.org/scheme/perseus/role/energy-data-provider"],
+    ),
+    "cap": (
+        98765,
+        "Carbon Accounting provider",
+        "https://directory.core.trust.ib1.org/application/26241",
+        "https://directory.core.trust.ib1.org/member/81524",
+        [
+            "https://registry.core.trust.ib1.org/scheme/perseus/role/carbon-accounting-provider"
+        ],
+    ),
+    "bank": (
+        88889999,
+        "Financial Service Provider",
+        "https://directory.core.trust.ib1.org/application/261551511",
+        "https://directory.core.trust.ib1.org/member/71212388",
+        [
+            "https://registry.core.trust.ib1.org/scheme/perseus/role/financial-service-provider",
+            "https://registry.core.trust.ib1.org/scheme/example/role/auditor",
+        ],
+    ),
+}
+
+
+class PKI:
+    def __init__(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.not_before = now - datetime.timedelta(days=1)
+        self.not_after = now + datetime.timedelta(days=365)
+        self.root_key = ec.generate_private_key(ec.SECP256R1())
+        self.root_cert = self._ca_certificate(
+            "Core Trust Framework Signing CA", self.root_key, None, None, None
+        )
+        self.issuer_key = ec.generate_private_key(ec.SECP256R1())
+        self.issuer_cert = self._ca_certificate(
+            "Core Trust Framework Signing Issuer",
+            self.issuer_key,
+            self.root_cert,
+            self.root_key,
+            0,
+        )
+        self.members = {}
+        for name, details in MEMBERS.items():
+            key = ec.generate_private_key(ec.SECP256R1())
+            self.members[name] = (self._member_certificate(key, *details), key)
+
+    def root_ca_pem(self):
+        return self.root_cert.public_bytes(serialization.Encoding.PEM)
+
+    def certificates(self, name):
+        return [self.members[name][0], self.issuer_cert]
+
+    def private_key(self, name):
+        return self.members[name][1]
+
+    def write_bundles(self, directory):
+        for name, (cert, key) in self.members.items():
+            with open(
+                str(directory) + "/" + str(cert.serial_number) + "-bundle.pem", "wb"
+            ) as f:
+                for c in self.certificates(name):
+                    f.write(c.public_bytes(serialization.Encoding.PEM))
+
+    def _ca_certificate(self, common_name, key, issuer_cert, issuer_key, path_length):
+        subject = x509.Name(
+            [
+                x509.NameAttribute(NameOID.COUNTRY_NAME, "GB"),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Core Trust Framework"),
+                x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+            ]
+        )
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject if issuer_cert is None else issuer_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(self.not_before)
+            .not_valid_after(self.not_after)
+            .add_extension(
+                x509.BasicConstraints(ca=True, path_length=path_length), critical=True
+            )
+            .add_extension(
+                x509.KeyUsage(
+                    digital_signature=True,
+                    content_commitment=False,
+                    key_encipherment=False,
+                    data_encipherment=False,
+                    key_agreement=False,
+                    key_cert_sign=True,
+                    crl_sign=True,
+                    encipher_only=False,
+                    decipher_only=False,
+                ),
+                critical=True,
+            )
+            .add_extension(
+                x509.SubjectKeyIdentifier.from_public_key(key.public_key()),
+                critical=False,
+            )
+        )
+        signing_key = key if issuer_key is None else issuer_key
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                signing_key.public_key()
+            ),
+            critical=False,
+        )
+        return builder.sign(signing_key, hashes.SHA256())
+
+    def _member_certificate(self, key, serial, organisation, application, member, roles):
+        subject = x509.Name(
+            [
+                x509.NameAttribute(NameOID.COUNTRY_NAME, "GB"),
+                x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "London"),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, organisation),
+                x509.NameAttribute(NameOID.COMMON_NAME, application),
+            ]
+        )
+        return (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(self.issuer_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(serial)
+            .not_valid_before(self.not_before)
+            .not_valid_after(self.not_after)
+            .add_extension(
+                x509.SubjectAlternativeName([x509.UniformResourceIdentifier(application)]),
+                critical=False,
+            )
+            .add_extension(
+                x509.UnrecognizedExtension(
+                    OID_IB1_ROLES, CertExtUTF8Sequence(roles).dump()
+                ),
+                critical=False,
+            )
+            .add_extension(
+                x509.UnrecognizedExtension(
+                    OID_IB1_MEMBER, asn1.UTF8String(member).dump()
+                ),
+                critical=False,
+            )
+            .add_extension(
+                x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(
+                    self.issuer_cert.extensions.get_extension_for_oid(
+                        ExtensionOID.SUBJECT_KEY_IDENTIFIER
+                    ).value
+                ),
+                critical=False,
+            )
+            .sign(self.issuer_key, hashes.SHA256())
+        )
+
+
+@pytest.fixture(scope="session")
+def pki():
+    return PKI()
+
+
+@pytest.fixture(params=["self-contained", "local"])
+def provider(request, pki, tmp_path):
+    if request.param == "self-contained":
+        return CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    pki.write_bundles(tmp_path)
+    return CertificatesProviderLocal(pki.root_ca_pem(), str(tmp_path))
+
+
+def make_signer(pki, provider, member):
+    return SignerInMemory(
+        provider, pki.certificates(member), pki.private_key(member)
+    )
+
+
+def three_hop_record(pki, provider):
+    # EDP -> CAP -> Bank, as in main.py
+    edp_record = Record(TRUST_FRAMEWORK_URL)
+    origin_id = edp_record.add_step({"type": "origin", "scheme": SCHEME})
+    edp_record.add_step(
+        {"type": "transfer", "scheme": SCHEME, "of": origin_id, "to": CAP_MEMBER}
+    )
+    edp_signed = edp_record.sign(make_signer(pki, provider, "edp"))
+
+    cap_record = Record(TRUST_FRAMEWORK_URL, edp_signed.encoded())
+    cap_record.verify(provider)
+    transfer = cap_record.find_step({"type": "transfer", "to": CAP_MEMBER})
+    receipt_id = cap_record.add_step({"type": "receipt", "transfer": transfer["id"]})
+    intensity_id = cap_record.add_step({"type": "origin", "scheme": SCHEME})
+    process_id = cap_record.add_step(
+        {"type": "process", "inputs": [receipt_id, intensity_id]}
+    )
+    cap_record.add_step(
+        {"type": "transfer", "scheme": SCHEME, "of": process_id, "to": BANK_MEMBER}
+    )
+    cap_signed = cap_record.sign(make_signer(pki, provider, "cap"))
+
+    bank_record = Record(TRUST_FRAMEWORK_URL, cap_signed.encoded())
+    bank_record.verify(provider)
+    transfer = bank_record.find_step({"type": "transfer", "to": BANK_MEMBER})
+    bank_record.add_step({"type": "receipt", "transfer": transfer["id"]})
+    return bank_record.sign(make_signer(pki, provider, "bank"))
@@ -0,0 +1,56 @@
+from unittest.mock import patch
+
+import pytest
+
+from ib1.provenance import Record, verify_many, sign_many
+from conftest import TRUST_FRAMEWORK_URL, SCHEME, make_signer, three_hop_record
+
+
+def test_verify_many(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    bad = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    bad.encoded()["origins"] = []
+    for workers in [None, 4]:
+        results = verify_many(
+            [encoded, {"steps": "junk"}, bad, Record(TRUST_FRAMEWORK_URL, encoded)],
+            provider,
+            workers=workers,
+            trust_framework=TRUST_FRAMEWORK_URL,
+        )
+        assert len(results) == 4
+        record, error = results[0]
+        assert error is None
+        assert len(record.decoded()) == 7
+        assert results[1][0] is None
+        assert "Not an encoded Provenance record" in str(results[1][1])
+        assert results[2][0] is bad
+        assert "origins property does not match" in str(results[2][1])
+        assert results[3][1] is None
+        assert results[3][0].decoded() == record.decoded()
+
+
+def test_verify_many_requires_trust_framework(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    [(record, error)] = verify_many([encoded], provider)
+    assert record is None
+    assert "trust_framework must be specified" in str(error)
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_sign_many(pki, provider, workers):
+    records = []
+    for n in range(5):
+        record = Record(TRUST_FRAMEWORK_URL)
+        record.add_step({"type": "origin", "scheme": SCHEME, "n": n})
+        records.append(record)
+    signer = make_signer(pki, provider, "edp")
+    with patch.object(
+        signer, "certificates_for_record", wraps=signer.certificates_for_record
+    ) as certificates_for_record:
+        signed = sign_many(records, signer, workers=workers)
+        assert certificates_for_record.call_count <= 1
+    assert len(signed) == 5
+    results = verify_many(signed, provider)
+    for n, (record, error) in enumerate(results):
+        assert error is None
+        assert record.find_step({"type": "origin"})["n"] == n
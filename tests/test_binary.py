@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from ib1.provenance import Record, encode_binary, decode_binary
+from conftest import TRUST_FRAMEWORK_URL, three_hop_record
+
+
+def test_binary_round_trip(pki, provider):
+    record = three_hop_record(pki, provider)
+    binary = record.encoded_binary()
+    encoded = decode_binary(binary)
+    assert encoded == record.encoded()
+    # Same JSON text, so signatures stay valid when passed on in either form
+    assert json.dumps(encoded) == json.dumps(record.encoded())
+    assert len(binary) < len(json.dumps(record.encoded())) * 0.8
+    verified = Record(TRUST_FRAMEWORK_URL, encoded)
+    verified.verify(provider)
+    assert len(verified.decoded()) == 7
+
+
+def test_binary_non_canonical_values(pki, provider):
+    encoded = json.loads(json.dumps(three_hop_record(pki, provider).encoded()))
+    # Values which can't be represented as raw bytes are kept as text
+    encoded["steps"][1] = encoded["steps"][1].rstrip("=") + "!"
+    encoded["certificates"] = {"1": ["not a PEM certificate\n"]}
+    encoded["extension"] = {"x": [1, 2]}
+    assert decode_binary(encode_binary(encoded)) == encoded
+
+
+def test_binary_bad_input():
+    with pytest.raises(Exception, match="Not a binary encoded"):
+        decode_binary(b"{\"steps\": []}")
+    with pytest.raises(Exception, match="Unexpected end"):
+        decode_binary(b"IB1P\x00\x00\x05ab")
+    with pytest.raises(Exception, match="Not an encoded Provenance record"):
+        encode_binary({"ib1:provenance": TRUST_FRAMEWORK_URL})
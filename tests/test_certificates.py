@@ -2,7 +2,11 @@ import os
 import json
 
 import pytest
-from ib1.provenance import certificates
+from cryptography.x509.verification import VerificationError
+
+from ib1.provenance import certificates, Record
+from ib1.provenance.signing import SignerInMemory
+from conftest import TRUST_FRAMEWORK_URL, three_hop_record
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -30,3 +34,184 @@ def test_certificate_self_contained_record_certificates_for_serial_bad_serial():
         provider.certificates_for_serial(
             certificates_from_record=certificates_from_record, serial="1"
         )
+
+
+def _signed_record(pki, provider, member="edp"):
+    signer = SignerInMemory(
+        provider, pki.certificates(member), pki.private_key(member)
+    )
+    record = Record(TRUST_FRAMEWORK_URL)
+    record.add_step({"type": "origin", "scheme": "https://example.com/scheme"})
+    return Record(TRUST_FRAMEWORK_URL, record.sign(signer).encoded())
+
+
+def test_chain_verification_cache(pki):
+    provider = certificates.CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    for _ in range(3):
+        _signed_record(pki, provider).verify(provider)
+    stats = provider.chain_verification_cache.statistics()
+    assert stats["size"] == 1
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    provider.invalidate_chain_verification_cache()
+    assert provider.chain_verification_cache.statistics()["size"] == 0
+
+
+def test_chain_verification_cache_outside_validity_window(pki):
+    provider = certificates.CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    record = _signed_record(pki, provider)
+    record.verify(provider)
+    certs = provider.certificates_for_serial(
+        record.encoded()["certificates"], "123456"
+    )
+    signing_cert, *issuer_chain = certs
+    too_late = pki.not_after + certificates.datetime.timedelta(days=1)
+    with pytest.raises(VerificationError):
+        provider._verify_chain("123456", signing_cert, issuer_chain, too_late)
+
+
+def test_chain_verification_cache_disabled(pki):
+    provider = certificates.CertificatesProviderSelfContainedRecord(
+        pki.root_ca_pem(), chain_verification_cache_size=0
+    )
+    _signed_record(pki, provider).verify(provider)
+    _signed_record(pki, provider).verify(provider)
+    assert provider.chain_verification_cache.statistics()["size"] == 0
+
+
+def test_local_certificate_cache(pki, tmp_path):
+    pki.write_bundles(tmp_path)
+    provider = certificates.CertificatesProviderLocal(
+        pki.root_ca_pem(), str(tmp_path)
+    )
+    first = provider.certificates_for_serial(None, "123456")
+    second = provider.certificates_for_serial(None, "123456")
+    assert first == second
+    assert provider.certificate_cache.statistics()["hits"] == 1
+    # Replacing the bundle on disk is noticed
+    bundle = tmp_path / "123456-bundle.pem"
+    (tmp_path / "98765-bundle.pem").replace(bundle)
+    os.utime(bundle, ns=(0, 0))
+    reloaded = provider.certificates_for_serial(None, "123456")
+    assert reloaded[0].serial_number == 98765
+
+
+def test_local_certificate_cache_preload(pki, tmp_path):
+    pki.write_bundles(tmp_path)
+    (tmp_path / "not-a-bundle.pem").write_text("")
+    provider = certificates.CertificatesProviderLocal(
+        pki.root_ca_pem(), str(tmp_path), certificate_cache_size=2, preload=True
+    )
+    assert provider.certificate_cache.statistics()["size"] == 2
+    assert provider.preload() == ["123456", "88889999", "98765"]
+    _signed_record(pki, provider).verify(provider)
+
+
+def test_local_prefetch_record(pki, tmp_path):
+    pki.write_bundles(tmp_path)
+    provider = certificates.CertificatesProviderLocal(pki.root_ca_pem(), str(tmp_path))
+    record = three_hop_record(pki, provider)
+    provider.certificate_cache.clear()
+    assert provider.prefetch_record(record) == ["123456", "88889999", "98765"]
+    assert provider.prefetch_record(record) == []
+    # Unknown signers are rejected before any signature is verified
+    with pytest.raises(FileNotFoundError):
+        provider.prefetch(["123456", "1"])
+
+
+def test_self_contained_certificate_cache():
+    with open(ROOT_DIR + "/fixtures/4-signing-ca-cert.pem", "rb") as f:
+        root_ca_certificate = f.read()
+    provider = certificates.CertificatesProviderSelfContainedRecord(root_ca_certificate)
+    with open(ROOT_DIR + "/fixtures/certificates_from_record.json", "r") as f:
+        certificates_from_record = json.load(f)
+    for serial in ["123456", "98765", "88889999"]:
+        provider.certificates_for_serial(certificates_from_record, serial)
+    # Three signing certificates and the shared issuer are each parsed once
+    stats = provider.certificate_cache.statistics()
+    assert stats["size"] == 4
+    assert stats["misses"] == 4
+    assert stats["hits"] == 2
+
+
+def test_certificate_references(pki):
+    provider = certificates.CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    record = three_hop_record(pki, provider)
+    full = record.encoded()["certificates"]
+    # The receiver already has the issuer certificate, shared by every signer
+    bundle = certificates.CertificateBundle()
+    issuer_reference = bundle.add_certificate(pki.issuer_cert)
+    assert issuer_reference == certificates.certificate_reference(pki.issuer_cert)
+    encoded = record.encoded_with_certificate_references(bundle)
+    referenced = encoded["certificates"]
+    assert record.encoded()["certificates"] == full
+    assert encoded["steps"] is record.encoded()["steps"]
+    issuer_serial = str(pki.issuer_cert.serial_number)
+    assert referenced[issuer_serial] == [issuer_reference]
+    assert sum(c[0] == issuer_reference for c in referenced.values()) == 1
+    assert len(json.dumps(referenced)) < len(json.dumps(full))
+
+    without_bundle = Record(TRUST_FRAMEWORK_URL, encoded)
+    with pytest.raises(KeyError, match="no bundle"):
+        without_bundle.verify(provider)
+    with_bundle = certificates.CertificatesProviderSelfContainedRecord(
+        pki.root_ca_pem(), certificate_bundle=bundle
+    )
+    verified = Record(TRUST_FRAMEWORK_URL, encoded)
+    verified.verify(with_bundle)
+    assert len(verified.decoded()) == 7
+    with pytest.raises(KeyError, match="not in bundle"):
+        Record(TRUST_FRAMEWORK_URL, encoded).verify(
+            certificates.CertificatesProviderSelfContainedRecord(
+                pki.root_ca_pem(), certificate_bundle=certificates.CertificateBundle()
+            )
+        )
+
+
+def test_certificate_references_merged_when_signing(pki):
+    provider = certificates.CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    bundle = certificates.CertificateBundle()
+    bundle.add_certificates_from_record(
+        _signed_record(pki, provider, "edp").encoded()["certificates"]
+    )
+    assert len(bundle) == 2
+    # A record referencing every certificate, passed on by the edp
+    referenced = _signed_record(
+        pki, provider, "edp"
+    ).encoded_with_certificate_references(bundle.references())
+    assert all(
+        certificates.is_certificate_reference(c[0])
+        for c in referenced["certificates"].values()
+    )
+    record = Record(TRUST_FRAMEWORK_URL, referenced)
+    record.add_step({"type": "receipt", "transfer": "x"})
+    # Re-signing by the same signer includes its certificates in full again
+    signed = record.sign(
+        SignerInMemory(provider, pki.certificates("edp"), pki.private_key("edp"))
+    )
+    assert not any(
+        certificates.is_certificate_reference(c[0])
+        for c in signed.encoded()["certificates"].values()
+    )
+    Record(TRUST_FRAMEWORK_URL, signed.encoded()).verify(provider)
+
+
+def test_signer_info():
+    signer_info = certificates.SignerInfo.intern(
+        "https://example.org/member/1", "Example", "https://example.org/app", ["role"]
+    )
+    assert signer_info is certificates.SignerInfo.intern(
+        "https://example.org/member/1", "Example", "https://example.org/app", ("role",)
+    )
+    assert signer_info == {
+        "member": "https://example.org/member/1",
+        "name": "Example",
+        "application": "https://example.org/app",
+        "roles": ("role",),
+    }
+    assert json.loads(json.dumps(signer_info))["roles"] == ["role"]
+    with pytest.raises(TypeError):
+        signer_info["name"] = "Other"
+    with pytest.raises(TypeError):
+        signer_info.update(name="Other")
+    assert signer_info["name"] == "Example"
@@ -0,0 +1,195 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+
+from ib1.provenance import Record
+from ib1.provenance.certificates import CertificatesProviderDirectory
+from conftest import TRUST_FRAMEWORK_URL, three_hop_record
+
+
+class DirectoryStandIn:
+    # Local HTTP server serving certificate bundles by serial
+    def __init__(self, pki, delay=0):
+        self.bundles = {}
+        for name in pki.members:
+            certs = pki.certificates(name)
+            self.bundles["/" + str(certs[0].serial_number) + "-bundle.pem"] = b"".join(
+                c.public_bytes(serialization.Encoding.PEM) for c in certs
+            )
+        self.delay = delay
+        self.requests = []
+        # Requests wait until this many are in flight, or a timeout
+        self.hold_until_in_flight = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.condition = threading.Condition()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stand_in.requests.append(self.path)
+                with stand_in.condition:
+                    stand_in.in_flight += 1
+                    stand_in.max_in_flight = max(
+                        stand_in.max_in_flight, stand_in.in_flight
+                    )
+                    stand_in.condition.notify_all()
+                    stand_in.condition.wait_for(
+                        lambda: stand_in.in_flight >= stand_in.hold_until_in_flight,
+                        timeout=5,
+                    )
+                time.sleep(stand_in.delay)
+                with stand_in.condition:
+                    stand_in.in_flight -= 1
+                body = stand_in.bundles.get(self.path.removeprefix("/directory"))
+                self.send_response(404 if body is None else 200)
+                body = body or b""
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:%d/directory" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def directory(pki):
+    stand_in = DirectoryStandIn(pki)
+    yield stand_in
+    stand_in.stop()
+
+
+def _provider(pki, directory, **kwargs):
+    return CertificatesProviderDirectory(
+        pki.root_ca_pem(), directory.base_url, **kwargs
+    )
+
+
+def _wait_for(condition):
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_directory_verify(pki, directory, tmp_path):
+    provider = _provider(pki, directory, cache_directory=str(tmp_path))
+    assert provider.policy_include_certificates_in_record is False
+    encoded = three_hop_record(pki, provider).encoded()
+    assert "certificates" not in encoded
+    # Signers of the EDP and CAP containers, which were verified by the next hop
+    assert len(directory.requests) == 2
+    Record(TRUST_FRAMEWORK_URL, encoded).verify(provider)
+    Record(TRUST_FRAMEWORK_URL, encoded).verify(provider)
+    requests = len(directory.requests)
+    assert requests == 3
+    # Connections are kept alive and reused
+    assert provider._pool.connections_opened == 1
+    # A new provider uses the bundles cached on disk
+    provider = _provider(pki, directory, cache_directory=str(tmp_path))
+    Record(TRUST_FRAMEWORK_URL, encoded).verify(provider)
+    assert len(directory.requests) == requests
+    provider.close()
+
+
+def test_directory_unknown_serial(pki, directory):
+    clock = Clock()
+    provider = _provider(pki, directory, not_found_ttl=60, clock=clock)
+    with pytest.raises(KeyError, match="not in Directory"):
+        provider.certificates_for_serial({}, "1")
+    assert len(directory.requests) == 1
+    # Not found is remembered, for records and prefetching
+    with pytest.raises(KeyError, match="not in Directory"):
+        provider.certificates_for_serial({}, "1")
+    with pytest.raises(KeyError, match="not in Directory"):
+        provider.prefetch(["123456", "1"])
+    assert len(directory.requests) == 1
+    # Until not_found_ttl has passed
+    clock.now += 60
+    with pytest.raises(KeyError, match="not in Directory"):
+        provider.certificates_for_serial({}, "1")
+    assert len(directory.requests) == 2
+
+
+def test_directory_ttl_and_stale_while_revalidate(pki, directory):
+    clock = Clock()
+    provider = _provider(pki, directory, ttl=60, stale_while_revalidate=60, clock=clock)
+    provider.certificates_for_serial({}, "123456")
+    assert len(directory.requests) == 1
+    clock.now += 30
+    provider.certificates_for_serial({}, "123456")
+    assert len(directory.requests) == 1
+    # Stale, so the cached bundle is returned and fetched in the background
+    clock.now += 60
+    directory.delay = 0.2
+    provider.certificates_for_serial({}, "123456")
+    provider.certificates_for_serial({}, "123456")
+    _wait_for(lambda: provider.certificate_cache.get("123456")[0] == clock.now)
+    assert len(directory.requests) == 2
+    # Beyond stale-while-revalidate, so fetched before returning
+    directory.delay = 0
+    clock.now += 200
+    provider.certificates_for_serial({}, "123456")
+    assert len(directory.requests) == 3
+
+
+def test_directory_coalesces_requests(pki, directory):
+    provider = _provider(pki, directory)
+    directory.delay = 0.2
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(provider.certificates_for_serial({}, "98765"))
+        )
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 8
+    assert directory.requests == ["/directory/98765-bundle.pem"]
+
+
+def test_directory_prefetch_record(pki, directory):
+    provider = _provider(pki, directory)
+    encoded = three_hop_record(pki, provider).encoded()
+    provider = _provider(pki, directory, max_connections=3)
+    directory.requests.clear()
+    directory.max_in_flight = 0
+    directory.hold_until_in_flight = 3
+    record = Record(TRUST_FRAMEWORK_URL, encoded)
+    assert provider.prefetch_record(record) == ["123456", "88889999", "98765"]
+    # Fetched concurrently
+    assert directory.max_in_flight == 3
+    directory.hold_until_in_flight = 0
+    assert sorted(directory.requests) == [
+        "/directory/123456-bundle.pem",
+        "/directory/88889999-bundle.pem",
+        "/directory/98765-bundle.pem",
+    ]
+    assert provider.prefetch_record(record) == []
+    Record(TRUST_FRAMEWORK_URL, encoded).verify(provider)
+    assert len(directory.requests) == 3
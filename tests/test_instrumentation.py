@@ -0,0 +1,86 @@
+import pytest
+
+from ib1.provenance import Record, HistogramInstrumentation
+from ib1.provenance.cache import VerifiedContainerCache
+from ib1.provenance.instrumentation import NULL_INSTRUMENTATION
+from conftest import TRUST_FRAMEWORK_URL, three_hop_record
+
+
+def test_histogram_percentiles():
+    instrumentation = HistogramInstrumentation()
+    for i in range(1, 101):
+        instrumentation.duration("phase", i / 1000)
+    instrumentation.count("bytes", 10)
+    instrumentation.count("bytes", 5)
+    instrumentation.cache("cache", True)
+    instrumentation.cache("cache", False)
+    instrumentation.cache("cache", True)
+    exported = instrumentation.export()
+    durations = exported["durations"]["phase"]
+    assert durations["count"] == 100
+    assert durations["total"] == pytest.approx(5.05)
+    assert durations["min"] == 0.001
+    assert durations["max"] == 0.1
+    # Within the resolution of the buckets
+    assert durations["p50"] == pytest.approx(0.05, rel=0.2)
+    assert durations["p99"] == pytest.approx(0.099, rel=0.2)
+    assert durations["p50"] <= durations["p90"] <= durations["p99"] <= 0.1
+    assert exported["counts"] == {"bytes": 15}
+    assert exported["caches"] == {"cache": {"hits": 2, "misses": 1}}
+    instrumentation.reset()
+    assert instrumentation.export() == {"durations": {}, "counts": {}, "caches": {}}
+
+
+def test_histogram_phase():
+    instrumentation = HistogramInstrumentation()
+    with pytest.raises(ValueError):
+        with instrumentation.phase("failing"):
+            raise ValueError()
+    assert instrumentation.export()["durations"]["failing"]["count"] == 1
+
+
+def test_instrumented_verify(pki, provider):
+    assert provider.instrumentation is NULL_INSTRUMENTATION
+    record = three_hop_record(pki, provider)
+    instrumentation = HistogramInstrumentation()
+    provider.instrumentation = instrumentation
+    container_cache = VerifiedContainerCache()
+    for _ in range(2):
+        verified = Record(TRUST_FRAMEWORK_URL, record.encoded())
+        verified.verify(provider, container_cache=container_cache)
+    exported = instrumentation.export()
+    durations = exported["durations"]
+    assert durations["record.verify"]["count"] == 2
+    for phase in ["containers", "signatures", "decode"]:
+        assert durations["record.verify." + phase]["count"] == 2
+    # The second verification is entirely from the container cache
+    for phase in ["load", "chain", "signature"]:
+        assert durations["certificates." + phase]["count"] == 3
+    counts = exported["counts"]
+    assert counts["record.verify.containers"] == 3 + 1
+    assert counts["record.verify.steps"] == 14
+    assert counts["record.verify.bytes"] > 0
+    assert exported["caches"]["record.container_cache"] == {"hits": 1, "misses": 3}
+    assert sum(exported["caches"]["certificates.chain"].values()) == 3
+
+
+def test_instrumented_sign(pki, provider):
+    instrumentation = HistogramInstrumentation()
+    provider.instrumentation = instrumentation
+    record = three_hop_record(pki, provider)
+    exported = instrumentation.export()
+    assert exported["durations"]["record.sign"]["count"] == 3
+    assert exported["durations"]["record.sign.prepare"]["count"] == 3
+    assert exported["durations"]["signer.sign"]["count"] == 3
+    assert exported["counts"]["record.sign.steps"] == 7
+    # Each container was signed once
+    expected = 0
+    containers = [record.encoded()["steps"]]
+    while containers:
+        *data, sig_block = containers.pop()
+        version, serial, sign_timestamp, _ = sig_block
+        signed = record._data_for_signing(data, [str(version), serial, sign_timestamp])
+        expected += len(signed)
+        containers.extend(e for e in data if isinstance(e, list))
+    assert exported["counts"]["record.sign.bytes"] == expected
+    assert "signer.bytes" not in exported["counts"]
@@ -0,0 +1,67 @@
+import pytest
+
+from ib1.provenance.query import (
+    compile_query,
+    SIGNER_MEMBER_INDEX,
+    SIGNER_ROLES_INDEX,
+)
+
+STEP = {
+    "id": "abc",
+    "type": "transfer",
+    "parameters": {"from": "2023-09Z", "to": "2024-09Z"},
+    "permissions": ["p1", "p2"],
+    "inputs": [{"id": "i1", "n": 1}, {"id": "i2", "n": 2}],
+    "_signature": {
+        "signed": {"member": "m1", "roles": ["r1", "r2"]},
+        "includedBy": [{"member": "m2"}],
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "required_values,expected",
+    [
+        ({}, True),
+        ({"type": "transfer"}, True),
+        ({"type": "receipt"}, False),
+        ({"missing": None}, False),
+        ({"parameters": {"to": "2024-09Z"}}, True),
+        ({"parameters": {"to": "2025-09Z"}}, False),
+        ({"parameters": "2024-09Z"}, False),
+        ({"permissions": ["p2"]}, True),
+        ({"permissions": ["p2", "p3"]}, False),
+        ({"permissions": {"p2": 1}}, False),
+        ({"inputs": [{"n": 2}, {"id": "i1"}]}, True),
+        ({"inputs": [{"n": 3}]}, False),
+        ({"_signature": {"signed": {"member": "m1", "roles": ["r2"]}}}, True),
+        ({"_signature": {"includedBy": [{"member": "m2"}]}}, True),
+        ({"_signature": {"includedBy": [{"member": "m1"}]}}, False),
+    ],
+)
+def test_compiled_query_matches(required_values, expected):
+    assert compile_query(required_values).matches(STEP) is expected
+
+
+def test_compiled_query_copies_required_values():
+    required_values = {"type": "transfer", "permissions": ["p1"]}
+    query = compile_query(required_values)
+    required_values["type"] = "receipt"
+    required_values["permissions"].append("p3")
+    assert query.matches(STEP)
+
+
+def test_compiled_query_index_lookups():
+    query = compile_query(
+        {
+            "type": "transfer",
+            "parameters": {"to": "2024-09Z"},
+            "_signature": {"signed": {"member": "m1", "roles": ["r1", "r2"]}},
+        }
+    )
+    assert query.index_lookups == (
+        ("type", "transfer"),
+        (SIGNER_MEMBER_INDEX, "m1"),
+        (SIGNER_ROLES_INDEX, "r1"),
+        (SIGNER_ROLES_INDEX, "r2"),
+    )
@@ -0,0 +1,403 @@
+import copy
+import hashlib
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+from cryptography.exceptions import InvalidSignature
+
+from ib1.provenance import Record, verify_many, verify_stream
+from ib1.provenance.certificates import CertificatesProviderSelfContainedRecord
+from ib1.provenance.query import (
+    compile_query,
+    SIGNER_MEMBER_INDEX,
+    SIGNER_ROLES_INDEX,
+)
+from ib1.provenance.cache import VerifiedContainerCache
+from ib1.provenance.steps import DecodedSteps
+from conftest import (
+    TRUST_FRAMEWORK_URL,
+    SCHEME,
+    CAP_MEMBER,
+    BANK_MEMBER,
+    make_signer,
+    three_hop_record,
+)
+
+AUDITOR_ROLE = "https://registry.core.trust.ib1.org/scheme/example/role/auditor"
+
+def test_sign_and_verify(pki, provider):
+    record = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    record.verify(provider)
+    steps = record.decoded()
+    assert [s["type"] for s in steps] == [
+        "origin",
+        "transfer",
+        "receipt",
+        "origin",
+        "process",
+        "transfer",
+        "receipt",
+    ]
+    assert len(record.encoded()["origins"]) == 2
+    edp_origin = record.find_step(
+        {
+            "type": "origin",
+            "_signature": {"includedBy": [{"member": CAP_MEMBER}]},
+        }
+    )
+    assert edp_origin["_signature"]["signed"]["name"] == "Smart Meter Reading Co"
+    assert [i["member"] for i in edp_origin["_signature"]["includedBy"]] == [
+        BANK_MEMBER,
+        CAP_MEMBER,
+    ]
+
+
+def test_verify_bad_signature(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    inner_sig_block = encoded["steps"][0][0][-1]
+    inner_sig_block[3] = encoded["steps"][0][-1][3]
+    with pytest.raises(InvalidSignature):
+        Record(TRUST_FRAMEWORK_URL, encoded).verify(provider)
+
+
+def test_verify_with_executor(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    serial = Record(TRUST_FRAMEWORK_URL, encoded)
+    serial.verify(provider)
+    concurrent = Record(TRUST_FRAMEWORK_URL, encoded)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        concurrent.verify(provider, executor=executor)
+    assert concurrent.decoded() == serial.decoded()
+
+
+class AuditingProvider(CertificatesProviderSelfContainedRecord):
+    # Overrides verify() to add checks, without overriding verify_digest()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.verify_calls = 0
+
+    def verify(self, *args):
+        self.verify_calls += 1
+        return super().verify(*args)
+
+
+class VerifyOnlyProvider:
+    # Provider with only verify(), returning plain dicts
+    def __init__(self, provider):
+        self._provider = provider
+        self.policy_include_certificates_in_record = True
+
+    def verify(self, *args):
+        signer_info = self._provider.verify(*args)
+        return {**signer_info, "roles": list(signer_info["roles"])}
+
+
+def test_verify_with_providers_without_digests(pki):
+    provider = CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    encoded = three_hop_record(pki, provider).encoded()
+    expected = Record(TRUST_FRAMEWORK_URL, encoded)
+    expected.verify(provider)
+    auditing = AuditingProvider(pki.root_ca_pem())
+    for other in [auditing, VerifyOnlyProvider(provider)]:
+        for lazy in [False, True]:
+            record = Record(TRUST_FRAMEWORK_URL, encoded)
+            record.verify(other, lazy=lazy)
+            steps = record.decoded()
+            assert (steps.to_list() if lazy else steps) == expected.decoded()
+        [(_, exception)] = verify_many(
+            [encoded], other, trust_framework=TRUST_FRAMEWORK_URL
+        )
+        assert exception is None
+        source = io.StringIO(json.dumps(encoded))
+        steps = list(verify_stream(source, TRUST_FRAMEWORK_URL, other))
+        assert steps == expected.decoded()
+    # Three containers, verified four times
+    assert auditing.verify_calls == 12
+
+
+def test_verify_with_container_cache(pki, provider):
+    edp_record = Record(TRUST_FRAMEWORK_URL)
+    edp_record.add_step({"type": "origin", "scheme": SCHEME})
+    edp_signed = edp_record.sign(make_signer(pki, provider, "edp"))
+    container_cache = VerifiedContainerCache()
+    cap_record = Record(TRUST_FRAMEWORK_URL, edp_signed.encoded())
+    cap_record.verify(provider, container_cache=container_cache)
+    cap_record.add_step({"type": "origin", "scheme": SCHEME})
+    encoded = cap_record.sign(make_signer(pki, provider, "cap")).encoded()
+
+    expected = Record(TRUST_FRAMEWORK_URL, encoded)
+    expected.verify(provider)
+    with patch.object(
+        provider, "verify_digest", wraps=provider.verify_digest
+    ) as verify:
+        # Only the new outer container is verified
+        record = Record(TRUST_FRAMEWORK_URL, encoded)
+        record.verify(provider, container_cache=container_cache)
+        assert verify.call_count == 1
+        assert record.decoded() == expected.decoded()
+        # Everything is now in the cache
+        record = Record(TRUST_FRAMEWORK_URL, encoded)
+        record.verify(provider, container_cache=container_cache)
+        assert verify.call_count == 1
+        assert record.decoded() == expected.decoded()
+    assert len(container_cache) == 2
+
+
+def test_container_cache_does_not_accept_modified_signature(pki, provider):
+    container_cache = VerifiedContainerCache()
+    encoded = three_hop_record(pki, provider).encoded()
+    Record(TRUST_FRAMEWORK_URL, encoded).verify(
+        provider, container_cache=container_cache
+    )
+    modified = copy.deepcopy(encoded)
+    modified["steps"][-1][3] = modified["steps"][0][-1][3]
+    with pytest.raises(InvalidSignature):
+        Record(TRUST_FRAMEWORK_URL, modified).verify(
+            provider, container_cache=container_cache
+        )
+
+
+def test_signed_records_do_not_share_certificates(pki, provider):
+    signer = make_signer(pki, provider, "edp")
+    record = Record(TRUST_FRAMEWORK_URL)
+    record.add_step({"type": "origin", "scheme": SCHEME})
+    first = record.sign(signer).encoded()
+    second = record.sign(signer).encoded()
+    if "certificates" not in first:
+        return
+    certificates = copy.deepcopy(first["certificates"])
+    for certs in first["certificates"].values():
+        certs[0] = "tampered"
+    assert second["certificates"] == certificates
+    assert record.sign(signer).encoded()["certificates"] == certificates
+
+
+def test_steps_decoded_once(pki, provider):
+    record = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    with patch("ib1.provenance.record.json.loads", wraps=json.loads) as loads:
+        record.verify(provider)
+        assert loads.call_count == 7
+        # Origins are known from verification, so signing doesn't decode steps
+        record.add_step({"type": "origin", "scheme": SCHEME})
+        signed = record.sign(make_signer(pki, provider, "bank"))
+        assert loads.call_count == 7
+        # The signed record decodes its steps independently
+        signed.verify(provider)
+        assert loads.call_count == 15
+        signed.verify(provider)
+        assert loads.call_count == 15
+    assert len(signed.encoded()["origins"]) == 3
+    assert signed.encoded()["origins"] == Record(
+        TRUST_FRAMEWORK_URL, copy.deepcopy(signed.encoded())
+    ).sign(make_signer(pki, provider, "bank")).encoded()["origins"]
+
+
+def test_verify_lazy(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    eager = Record(TRUST_FRAMEWORK_URL, encoded)
+    eager.verify(provider)
+    lazy = Record(TRUST_FRAMEWORK_URL, encoded)
+    lazy.verify(provider, lazy=True)
+    steps = lazy.decoded()
+    assert isinstance(steps, DecodedSteps)
+    assert lazy.decoded() is steps
+    assert len(lazy._decoded_steps) == 0
+    transfer = lazy.find_step({"type": "transfer", "to": BANK_MEMBER})
+    assert transfer == eager.find_step({"type": "transfer", "to": BANK_MEMBER})
+    with pytest.raises(TypeError):
+        transfer["to"] = CAP_MEMBER
+    assert steps.to_list() == eager.decoded()
+    assert [s["id"] for s in steps[1:3]] == [s["id"] for s in eager.decoded()[1:3]]
+    assert lazy.to_graphviz() == eager.to_graphviz()
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_modified_steps_do_not_change_verified_record(pki, provider, lazy):
+    record = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    record.verify(provider, lazy=lazy)
+    process = record.find_step({"type": "process"})
+    process["inputs"].append("FORGED")
+    process["_signature"]["includedBy"].clear()
+    record.verify(provider, lazy=lazy)
+    assert "FORGED" not in record.find_step({"type": "process"})["inputs"]
+    signed = record.sign(make_signer(pki, provider, "bank"))
+    signed.verify(provider, lazy=lazy)
+    process = signed.find_step({"type": "process"})
+    assert "FORGED" not in process["inputs"]
+    assert len(process["_signature"]["includedBy"]) == 2
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_verified_steps_are_plain_values(pki, provider, lazy):
+    record = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    record.verify(provider, lazy=lazy)
+    query = {"_signature": {"signed": {"roles": [AUDITOR_ROLE]}}}
+    step = record.find_step(query)
+    signed = step["_signature"]["signed"]
+    assert type(signed) is dict
+    assert type(signed["roles"]) is list
+    signed["roles"].clear()
+    assert AUDITOR_ROLE in record.find_step(query)["_signature"]["signed"]["roles"]
+    steps = record.decoded()
+    if lazy:
+        steps = steps.to_list()
+    else:
+        step = record.find_step(query)
+        assert json.loads(json.dumps(step)) == step
+    assert json.loads(json.dumps(steps)) == steps
+
+
+def test_verified_steps_share_signer_info(pki, provider):
+    record = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    record.verify(provider)
+    # Steps in the same container share _signature, and signer information is
+    # shared with the containers within it, in decoded() too
+    for steps in [record._verified, record.decoded()]:
+        assert steps[0]["_signature"] is steps[1]["_signature"]
+        bank = steps[-1]["_signature"]["signed"]
+        assert steps[0]["_signature"]["includedBy"][0] is bank
+    assert record.decoded()[0]["_signature"] is not record._verified[0]["_signature"]
+
+
+def test_lazy_steps_share_signer_info(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    record = Record(TRUST_FRAMEWORK_URL, encoded)
+    record.verify(provider, lazy=True)
+    other = Record(TRUST_FRAMEWORK_URL, encoded)
+    other.verify(provider, lazy=True)
+    origin, transfer, *_ = record.filter_steps({})
+    # Steps in the same container share their signer information, which is
+    # shared between records
+    assert origin._signature is transfer._signature
+    assert origin._signature["signed"] is other.filter_steps({})[0]._signature["signed"]
+    with pytest.raises(TypeError):
+        origin["type"] = "process"
+    with pytest.raises(TypeError):
+        origin._signature["signed"]["name"] = "Other"
+    assert origin.to_dict() == record.decoded().to_list()[0]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_filter_steps_uses_indexes(pki, provider, lazy):
+    record = Record(TRUST_FRAMEWORK_URL, three_hop_record(pki, provider).encoded())
+    record.verify(provider, lazy=lazy)
+    steps = list(record.decoded())
+    queries = [
+        ({"type": "origin"}, 2),
+        ({"type": "transfer", "to": CAP_MEMBER}, 1),
+        ({"type": "receipt", "_signature": {"signed": {"member": BANK_MEMBER}}}, 1),
+        ({"_signature": {"signed": {"roles": [AUDITOR_ROLE]}}}, 1),
+        ({"_signature": {"includedBy": [{"member": BANK_MEMBER}]}}, 7),
+        ({"type": "process", "inputs": []}, 1),
+        ({"type": "unknown"}, 0),
+        ({"id": steps[2]["id"]}, 1),
+    ]
+    for query, candidate_count in queries:
+        compiled = compile_query(query)
+        expected = [s for s in steps if compiled.matches(s)]
+        assert record.filter_steps(query) == expected
+        assert record.filter_steps(compiled) == expected
+        assert len(record._candidate_steps(compiled)) == candidate_count
+    assert set(record._step_indexes) == {
+        "type",
+        "to",
+        "id",
+        SIGNER_MEMBER_INDEX,
+        SIGNER_ROLES_INDEX,
+    }
+
+
+def reference_data_for_signing(trust_framework, data, additional=None, is_root=True):
+    # Original recursive implementation of Record._data_for_signing
+    gather = []
+    if is_root:
+        gather.append(trust_framework)
+    for e in data:
+        if isinstance(e, str):
+            gather.append(e)
+        elif isinstance(e, int):
+            gather.append(str(e))
+        else:
+            gather.append("%")
+            gather.append(reference_data_for_signing(trust_framework, e, None, False))
+            gather.append("&")
+    if additional is not None:
+        gather.extend(additional)
+    return ".".join(gather)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        [],
+        ["a", "b"],
+        [["a", 0, "1", "t", "sig"], "b"],
+        [[["x", [], "y"], 0], [], "z"],
+        [[[["deep", 0]]], 7, "é"],
+    ],
+)
+def test_data_for_signing(data):
+    record = Record(TRUST_FRAMEWORK_URL)
+    additional = ["0", "123456", "2024-01-01T00:00:00Z"]
+    assert record._data_for_signing(data, additional) == reference_data_for_signing(
+        TRUST_FRAMEWORK_URL, data, additional
+    ).encode("utf-8")
+
+
+class DataOnlySigner:
+    # Signer which can only sign the data, not a digest
+    def __init__(self, signer):
+        self._signer = signer
+
+    def serial(self):
+        return self._signer.serial()
+
+    def certificates_for_record(self):
+        return self._signer.certificates_for_record()
+
+    def sign(self, data):
+        assert data.startswith(TRUST_FRAMEWORK_URL.encode("utf-8"))
+        return self._signer.sign(data)
+
+
+def test_sign_with_signer_without_digests(pki, provider):
+    record = Record(TRUST_FRAMEWORK_URL)
+    record.add_step({"type": "origin", "scheme": SCHEME})
+    signed = record.sign(DataOnlySigner(make_signer(pki, provider, "edp")))
+    verified = Record(TRUST_FRAMEWORK_URL, signed.encoded())
+    verified.verify(provider)
+    assert verified.find_step({"type": "origin"})["scheme"] == SCHEME
+
+
+def test_digest_for_signing():
+    record = Record(TRUST_FRAMEWORK_URL)
+    data = [[["a", 0, "1", "t", "sig"], "é", []], "b"]
+    assert (
+        record._digest_for_signing(data, ["0"])
+        == hashlib.sha256(record._data_for_signing(data, ["0"])).digest()
+    )
+
+
+def test_signatures(pki, provider):
+    record = three_hop_record(pki, provider)
+    with patch("ib1.provenance.record.json.loads") as loads:
+        signatures = Record(TRUST_FRAMEWORK_URL, record.encoded()).signatures()
+        loads.assert_not_called()
+    assert [serial for serial, _ in signatures] == ["88889999", "98765", "123456"]
+    steps = record.encoded()["steps"]
+    assert signatures[0][1] == steps[-1][2]
+    for bad_steps, message in [
+        ([], "Bad container"),
+        ([["x"]], "Bad signature block"),
+        (["step", [[], [0, "1", "2", "3"]], [0, "1", "2", "3"]], "Bad container"),
+        (["step", ["0", "1", "2"]], "Bad signature block"),
+        (["step", [0, "12a", "2", "3"]], "Bad certificate serial"),
+        (["step", [0, "0123", "2", "3"]], "Bad certificate serial"),
+        (["step", [0, "\uff1088889999", "2", "3"]], "Bad certificate serial"),
+    ]:
+        bad = Record(TRUST_FRAMEWORK_URL, {**record.encoded(), "steps": bad_steps})
+        with pytest.raises(Exception, match=message):
+            bad.signatures()
@@ -1,12 +1,27 @@
+import asyncio
+import hashlib
 import os
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from unittest.mock import Mock, patch
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 
-from ib1.provenance.signing import SignerInMemory, SignerFiles, SignerKMS
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+
+from ib1.provenance import Record
+from ib1.provenance.signing import (
+    SignerInMemory,
+    SignerFiles,
+    SignerKMS,
+    SignerKMSAsync,
+)
 from ib1.provenance.certificates import CertificateProviderBase as CertificateProvider
+from conftest import TRUST_FRAMEWORK_URL
 
 # Test certificate (PEM format)
 TEST_CERT_PEM = """-----BEGIN CERTIFICATE-----
@@ -94,6 +109,32 @@ class TestSignerInMemory:
         result = signer.certificates_for_record()
         assert result is None
 
+    def test_encoded_certificates_for_record(self):
+        """Test certificates are encoded for records once, on first use"""
+        signer = SignerInMemory(
+            self.certificate_provider, self.certificates, self.private_key
+        )
+
+        result = signer.encoded_certificates_for_record()
+        assert result == {
+            signer.serial(): [
+                self.certificate.public_bytes(serialization.Encoding.PEM).decode()
+            ]
+        }
+        assert signer.encoded_certificates_for_record() is result
+
+    def test_encoded_certificates_for_record_no_policy(self):
+        """Test no certificates are returned when the policy excludes them"""
+        self.certificate_provider.policy_include_certificates_in_record = False
+        signer = SignerInMemory(
+            self.certificate_provider, self.certificates, self.private_key
+        )
+
+        assert signer.encoded_certificates_for_record() is None
+        # Certificates are only encoded if they're included in records
+        signer = SignerInMemory(self.certificate_provider, [], self.private_key)
+        assert signer.encoded_certificates_for_record() is None
+
     def test_sign_data(self):
         """Test signing data"""
         signer = SignerInMemory(
@@ -107,6 +148,20 @@ class TestSignerInMemory:
         assert len(signature) > 0
 
 
+    def test_sign_digest(self, pki):
+        """Test signing a digest gives a signature over the data"""
+        signer = SignerInMemory(
+            self.certificate_provider, pki.certificates("edp"), pki.private_key("edp")
+        )
+
+        test_data = b"test data to sign"
+        signature = signer.sign_digest(hashlib.sha256(test_data).digest())
+
+        pki.certificates("edp")[0].public_key().verify(
+            signature, test_data, ec.ECDSA(hashes.SHA256())
+        )
+
+
 class TestSignerFiles:
     """Test cases for SignerFiles class"""
 
@@ -305,6 +360,137 @@ class TestSignerKMS:
             assert certificates == self.certificates.copy()
 
 
+class ThrottlingError(Exception):
+    """Mimics botocore's ClientError for a throttled request"""
+
+    def __init__(self):
+        super().__init__("Rate exceeded")
+        self.response = {"Error": {"Code": "ThrottlingException"}}
+
+
+class LocalKMS:
+    """Stand-in for a boto3 KMS client, signing digests with a local key"""
+
+    def __init__(self, private_key, throttle_first=0, delay=0.01):
+        self._private_key = private_key
+        self._throttle_remaining = throttle_first
+        self._delay = delay
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def sign(self, KeyId, Message, MessageType, SigningAlgorithm):
+        assert MessageType == "DIGEST"
+        assert SigningAlgorithm == "ECDSA_SHA_256"
+        with self._lock:
+            self.calls += 1
+            if self._throttle_remaining > 0:
+                self._throttle_remaining -= 1
+                raise ThrottlingError()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self._delay)
+            signature = self._private_key.sign(
+                Message, ec.ECDSA(utils.Prehashed(hashes.SHA256()))
+            )
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return {
+            "KeyId": KeyId,
+            "Signature": signature,
+            "SigningAlgorithm": SigningAlgorithm,
+        }
+
+
+class TestSignerKMSAsync:
+    """Test cases for SignerKMSAsync class"""
+
+    def make_signer(self, pki, provider, kms_client, **kwargs):
+        with patch("importlib.util.find_spec", return_value=Mock()):
+            return SignerKMSAsync(
+                provider, pki.certificates("edp"), kms_client, "test-key-id", **kwargs
+            )
+
+    def test_sign_async_records(self, pki, provider):
+        """Test records signed asynchronously verify, with bounded requests in flight"""
+        kms = LocalKMS(pki.private_key("edp"))
+        latencies = []
+        signer = self.make_signer(
+            pki, provider, kms, max_in_flight=3, latency_callback=latencies.append
+        )
+
+        async def sign_records():
+            records = []
+            for n in range(8):
+                record = Record(TRUST_FRAMEWORK_URL)
+                record.add_step({"type": "origin", "n": n})
+                records.append(record)
+            return await asyncio.gather(*(r.sign_async(signer) for r in records))
+
+        signed = asyncio.run(sign_records())
+        assert kms.max_in_flight == 3
+        assert len(latencies) == 8
+        for n, record in enumerate(signed):
+            verified = Record(TRUST_FRAMEWORK_URL, record.encoded())
+            verified.verify(provider)
+            assert verified.find_step({"type": "origin"})["n"] == n
+
+    def test_sign_async_multiple_event_loops(self, pki, provider):
+        """Test the signer can be used with more than one event loop"""
+        kms = LocalKMS(pki.private_key("edp"))
+        signer = self.make_signer(pki, provider, kms, max_in_flight=2)
+
+        async def sign_many():
+            # More requests than max_in_flight, so requests wait on the semaphore
+            return await asyncio.gather(
+                *(signer.sign_async(b"test data to sign") for _ in range(4))
+            )
+
+        assert len(asyncio.run(sign_many())) == 4
+        assert len(asyncio.run(sign_many())) == 4
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(asyncio.run, sign_many()) for _ in range(2)]
+            assert [len(f.result()) for f in futures] == [4, 4]
+        assert kms.calls == 16
+
+    def test_sign_async_retries_throttling(self, pki, provider):
+        """Test throttled requests are retried"""
+        kms = LocalKMS(pki.private_key("edp"), throttle_first=2)
+        signer = self.make_signer(pki, provider, kms, initial_backoff=0.001)
+        signature = asyncio.run(signer.sign_async(b"test data to sign"))
+        assert kms.calls == 3
+        pki.certificates("edp")[0].public_key().verify(
+            signature, b"test data to sign", ec.ECDSA(hashes.SHA256())
+        )
+
+    def test_sign_async_gives_up(self, pki, provider):
+        """Test throttling errors are raised after the maximum number of retries"""
+        kms = LocalKMS(pki.private_key("edp"), throttle_first=10)
+        signer = self.make_signer(
+            pki, provider, kms, max_retries=2, initial_backoff=0.001
+        )
+        with pytest.raises(ThrottlingError):
+            asyncio.run(signer.sign_async(b"test data to sign"))
+        assert kms.calls == 3
+
+    def test_sign_async_coroutine_client(self, pki, provider):
+        """Test clients with a coroutine sign() method are awaited directly"""
+        local_kms = LocalKMS(pki.private_key("edp"), delay=0)
+
+        class AsyncKMS:
+            async def sign(self, **kwargs):
+                return local_kms.sign(**kwargs)
+
+        signer = self.make_signer(pki, provider, AsyncKMS())
+        signature = asyncio.run(signer.sign_async(b"test data to sign"))
+        pki.certificates("edp")[0].public_key().verify(
+            signature, b"test data to sign", ec.ECDSA(hashes.SHA256())
+        )
+
+
 class TestSignerIntegration:
     """Integration tests for all signer classes"""
 
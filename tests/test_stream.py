@@ -0,0 +1,90 @@
+import io
+import json
+
+import pytest
+
+from ib1.provenance import Record, verify_stream
+from conftest import TRUST_FRAMEWORK_URL, SCHEME, make_signer, three_hop_record
+
+
+def _verified_steps(record, provider):
+    verified = Record(TRUST_FRAMEWORK_URL, record.encoded())
+    verified.verify(provider)
+    return verified.decoded()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+def test_verify_stream(pki, provider, chunk_size):
+    record = three_hop_record(pki, provider)
+    encoded = json.dumps(record.encoded(), indent=2)
+    for source in [io.StringIO(encoded), io.BytesIO(encoded.encode("utf-8"))]:
+        steps = list(
+            verify_stream(source, TRUST_FRAMEWORK_URL, provider, chunk_size=chunk_size)
+        )
+        assert steps == _verified_steps(record, provider)
+
+
+def test_verify_stream_certificates_after_steps(pki, provider):
+    record = three_hop_record(pki, provider)
+    encoded = dict(record.encoded())
+    encoded["steps"] = encoded.pop("steps")
+    if "certificates" in encoded:
+        encoded["certificates"] = encoded.pop("certificates")
+    encoded["origins"] = encoded.pop("origins")
+    steps = list(
+        verify_stream(io.StringIO(json.dumps(encoded)), TRUST_FRAMEWORK_URL, provider)
+    )
+    assert steps == _verified_steps(record, provider)
+
+
+def test_verify_stream_yields_before_end(pki, provider):
+    record = Record(TRUST_FRAMEWORK_URL)
+    record.add_step({"type": "origin", "scheme": SCHEME})
+    signed = record.sign(make_signer(pki, provider, "edp"))
+    nested = Record(TRUST_FRAMEWORK_URL, signed.encoded())
+    nested.verify(provider)
+    nested.add_step({"type": "receipt", "transfer": "x"})
+    outer = nested.sign(make_signer(pki, provider, "cap"))
+    encoded = json.dumps(outer.encoded())
+    # Truncate after the nested container, which can be verified on its own
+    nested_end = encoded.index("]", encoded.index('"steps"')) + 1
+    steps = verify_stream(
+        io.StringIO(encoded[: nested_end + 2]), TRUST_FRAMEWORK_URL, provider
+    )
+    if provider.policy_include_certificates_in_record:
+        assert "certificates" in encoded[: encoded.index('"steps"')]
+    step = next(steps)
+    assert step["type"] == "origin"
+    assert step["_signature"]["signed"]["member"].endswith("/member/2876152")
+    with pytest.raises(Exception, match="Unexpected end of encoded record"):
+        next(steps)
+
+
+def test_verify_stream_bad_signature(pki, provider):
+    record = three_hop_record(pki, provider)
+    encoded = json.dumps(record.encoded())
+    # Corrupt a step in the innermost container
+    step = record.encoded()["steps"][0][0][0]
+    corrupted = encoded.replace(step, step[:-4] + "AAAA")
+    with pytest.raises(Exception):
+        list(verify_stream(io.StringIO(corrupted), TRUST_FRAMEWORK_URL, provider))
+
+
+def test_verify_stream_checks_record(pki, provider):
+    record = three_hop_record(pki, provider)
+    encoded = dict(record.encoded())
+    with pytest.raises(Exception, match="Unexpected trust framework"):
+        list(verify_stream(io.StringIO(json.dumps(encoded)), "https://x", provider))
+    encoded["origins"] = encoded["origins"][:1]
+    with pytest.raises(Exception, match="origins property does not match"):
+        list(
+            verify_stream(
+                io.StringIO(json.dumps(encoded)), TRUST_FRAMEWORK_URL, provider
+            )
+        )
+    # Properties must be separated by commas, as in JSON
+    encoded = json.dumps(record.encoded(), separators=(",", ":"))
+    assert ',"steps"' in encoded
+    encoded = encoded.replace(',"steps"', '"steps"')
+    with pytest.raises(Exception, match="Expected"):
+        list(verify_stream(io.StringIO(encoded), TRUST_FRAMEWORK_URL, provider))
@@ -0,0 +1,72 @@
+import copy
+
+import pytest
+
+from ib1.provenance import Record, validate_record, RecordLimits
+from ib1.provenance.certificates import CertificatesProviderSelfContainedRecord
+from conftest import TRUST_FRAMEWORK_URL, three_hop_record
+
+
+def test_validate_record(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    validate_record(encoded)
+    validate_record(
+        encoded,
+        RecordLimits(maximum_depth=3, maximum_containers=3, maximum_steps=7),
+    )
+    for limits, message in [
+        (RecordLimits(maximum_depth=2), "maximum container depth"),
+        (RecordLimits(maximum_containers=2), "maximum number of containers"),
+        (RecordLimits(maximum_steps=6), "maximum number of steps"),
+        (RecordLimits(maximum_step_size=16), "maximum step size"),
+    ]:
+        with pytest.raises(Exception, match=message):
+            validate_record(encoded, limits)
+    Record(TRUST_FRAMEWORK_URL, encoded).verify(provider)
+
+
+def test_validate_record_certificates(pki, provider):
+    encoded = three_hop_record(pki, provider).encoded()
+    if "certificates" not in encoded:
+        return
+    with pytest.raises(Exception, match="maximum number of certificates"):
+        validate_record(encoded, RecordLimits(maximum_certificates=2))
+    with pytest.raises(Exception, match="maximum certificate size"):
+        validate_record(encoded, RecordLimits(maximum_certificate_size=100))
+    bad = copy.deepcopy(encoded)
+    bad["certificates"]["123456"].append("x")
+    with pytest.raises(Exception, match="Bad certificates for serial 123456"):
+        validate_record(bad)
+
+
+@pytest.mark.parametrize(
+    "change, message",
+    [
+        (lambda e: e.pop("origins"), "origins property"),
+        (lambda e: e.update({"steps": {}}), "Bad container"),
+        (lambda e: e["steps"].pop(), "Bad signature block"),
+        (lambda e: e["steps"][-1].pop(), "Bad signature block"),
+        (lambda e: e["steps"][-1].__setitem__(0, True), "container format version"),
+        (lambda e: e["steps"][-1].__setitem__(1, "0123"), "serial number"),
+        (lambda e: e["steps"][-1].__setitem__(1, "１２"), "serial number"),
+        (lambda e: e["steps"][-1].__setitem__(3, "x" * 1000), "Bad signature"),
+        (lambda e: e["steps"].insert(0, 1), "Bad element"),
+        (lambda e: e["steps"][0].insert(0, []), "Bad container"),
+    ],
+)
+def test_validate_record_malformed(pki, change, message):
+    provider = CertificatesProviderSelfContainedRecord(pki.root_ca_pem())
+    encoded = copy.deepcopy(three_hop_record(pki, provider).encoded())
+    change(encoded)
+    with pytest.raises(Exception, match=message):
+        validate_record(encoded)
+
+
+def test_validate_record_deep_nesting():
+    # Far deeper than the recursion limit, without exhausting the stack
+    steps = [0, "1", "t", "s"]
+    for _ in range(100000):
+        steps = [steps, [0, "1", "t", "s"]]
+    encoded = {"ib1:provenance": TRUST_FRAMEWORK_URL, "origins": [], "steps": steps}
+    with pytest.raises(Exception, match="maximum container depth"):
+        validate_record(encoded)